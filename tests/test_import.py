@@ -0,0 +1,52 @@
+import tw2, sys, subprocess
+
+from nose.tools import eq_
+
+heavy = ['tw2.sqla.widgets', 'tw2.sqla.factory', 'tw2.forms', 'tw2.dynforms',
+         'zope.sqlalchemy', 'transaction', 'webob']
+
+script = '''
+import sys
+sys.path[:0] = %r
+import tw2
+tw2.__path__[:0] = %r
+%s
+print repr([m for m in %r if sys.modules.get(m)])
+'''
+
+
+def run_import(statement):
+    """Returns the heavy modules loaded by statement in a fresh interpreter
+    """
+    code = script % (sys.path, list(tw2.__path__), statement, heavy)
+    proc = subprocess.Popen([sys.executable, '-c', code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+    return eval(out.strip().splitlines()[-1])
+
+
+class TestImport(object):
+    def test_utils_alone(self):
+        eq_(run_import('import tw2.sqla.utils'), [])
+
+    def test_package(self):
+        eq_(run_import('import tw2.sqla'), [])
+
+    def test_public_name(self):
+        loaded = run_import('from tw2.sqla import DbListPage')
+        assert('tw2.sqla.widgets' in loaded)
+        assert('tw2.forms' in loaded)
+
+    def test_names(self):
+        import tw2.sqla as tws
+        for name in tws.__all__:
+            assert(getattr(tws, name) is not None)
+        eq_(tws.DbListPage.__module__, 'tw2.sqla.widgets')
+        eq_(tws.AutoTableForm.__module__, 'tw2.sqla.factory')
+        assert('DbListPage' in dir(tws))
+        try:
+            tws.NoSuchName
+            assert(False)
+        except AttributeError:
+            pass
@@ -55,12 +55,99 @@ class BaseObject(object):
             assert(False)
         except twc.ValidationError, e:
             assert(str(e) == 'from_python not passed instance of self.entity but instead "bob" of type "<type \'unicode\'>".')
-            
+
+    def test_lookup_cache(self):
+        testapi.request(1, twc.make_middleware(None))
+        vld = tws.RelatedValidator(self.DBTestCls1)
+        with self.counter:
+            assert(vld.to_python('1').id == 1)
+            assert(vld.to_python('1').id == 1)
+        assert(self.counter.count == 1)
+
+        vld = tws.RelatedValidator(self.DBTestCls1)
+        with self.counter:
+            for i in range(3):
+                try:
+                    vld.to_python('2')
+                    assert(False)
+                except twc.ValidationError:
+                    pass
+        # The miss is cached too
+        assert(self.counter.count == 1)
+
+    def test_lookup_cache_miss_flush(self):
+        testapi.request(1, twc.make_middleware(None))
+        vld = tws.RelatedValidator(self.DBTestCls1)
+        try:
+            vld.to_python('5')
+            assert(False)
+        except twc.ValidationError:
+            pass
+        session = sa.orm.object_session(self.DBTestCls1.query.get(1))
+        session.add(self.DBTestCls1(id=5))
+        session.flush()
+        # The flush drops the cached miss
+        assert(vld.to_python('5').id == 5)
+
+    def test_lookup_no_request(self):
+        # Outside of a request nothing is cached
+        vld = tws.RelatedValidator(self.DBTestCls1)
+        try:
+            vld.to_python('5')
+            assert(False)
+        except twc.ValidationError:
+            pass
+        table = sa.orm.class_mapper(self.DBTestCls1).local_table
+        table.insert().execute(id=5)
+        assert(vld.to_python('5').id == 5)
+
+    def test_lookup_cache_batch(self):
+        testapi.request(1, twc.make_middleware(None))
+        vld = tws.RelatedItemValidator(self.DBTestCls1, batch=True)
+        with self.counter:
+            assert(vld.item_validator.to_python('1').id == 1)
+            assert([o.id for o in vld.to_python(['1', '1'])] == [1, 1])
+        assert(self.counter.count == 1)
+
+    def test_item_batch(self):
+        session = sa.orm.object_session(self.DBTestCls1.query.get(1))
+        for i in range(2, 1200):
+            session.add(self.DBTestCls1(id=i))
+        session.flush()
+        vld = tws.RelatedItemValidator(self.DBTestCls1, batch=True)
+        ids = [str(i) for i in range(1199, 0, -1)]
+        with self.counter:
+            objs = vld.to_python(ids)
+        assert([o.id for o in objs] == range(1199, 0, -1))
+        # 1199 ids, in chunks of 500
+        assert(self.counter.count == 3)
+
+    def test_item_batch_norel(self):
+        vld = tws.RelatedItemValidator(self.DBTestCls1, batch=True)
+        try:
+            vld.to_python(['1', '55', 'x', '1', '56', '55'])
+            assert(False)
+        except twc.ValidationError, e:
+            # Reported once each, in the submitted order
+            assert(str(e) == 'No related object found: 55, x, 56')
+            assert(e.missing == [55, 'x', 56])
+
+    def test_item_batch_required(self):
+        vld = tws.RelatedItemValidator(self.DBTestCls1, batch=True,
+                                       required=True)
+        assert([o.id for o in vld.to_python(['1', ''])] == [1])
+        try:
+            vld.to_python([''])
+            assert(False)
+        except twc.ValidationError:
+            pass
+
 
 class TestElixir(BaseObject):
     def setUp(self):
         import transaction
         el.metadata = sa.MetaData('sqlite:///:memory:')
+        self.counter = testapi.QueryCounter(el.metadata.bind)
 
         class DBTestCls1(el.Entity):
             name = el.Field(el.String)
@@ -100,6 +187,7 @@ class TestSQLA(BaseObject):
         from sqlalchemy.ext.declarative import declarative_base
         Base = declarative_base(metadata=sa.MetaData('sqlite:///:memory:'))
         Base.query = tws.transactional_session().query_property()
+        self.counter = testapi.QueryCounter(Base.metadata.bind)
 
         class DBTestCls1(Base):
             __tablename__ = 'Test'
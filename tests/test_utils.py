@@ -318,6 +318,277 @@ class BaseObject(object):
         except Exception, e:
             assert([s in str(e) for s in ['cannot create', 'with pk']])
 
+    def test_from_dict_unchanged(self):
+        e = self.DBTestCls1.query.get(1)
+        changes = set()
+        twsu.from_dict(e, {'id': 1, 'name': 'foo', 'some_number': '2',
+                           'others': list(e.others)}, changes=changes)
+        eq_(changes, set())
+        assert(not sa.orm.attributes.instance_state(e).modified)
+
+    def test_from_dict_unchanged_coerced(self):
+        e = self.DBTestCls1.query.get(1)
+        e.some_number = 1
+        self.session.flush()
+        changes = set()
+        twsu.from_dict(e, {'some_number': True}, changes=changes)
+        twsu.from_dict(e, {'some_number': '1'}, changes=changes)
+        eq_(changes, set())
+        twsu.from_dict(e, {'some_number': 'x'}, changes=changes)
+        eq_(changes, set(['some_number']))
+
+    def test_coerce(self):
+        import datetime
+        eq_(twsu._coerce(bool, 'on'), True)
+        eq_(twsu._coerce(bool, '0'), False)
+        eq_(twsu._coerce(bool, 1), True)
+        eq_(twsu._coerce(int, True), 1)
+        eq_(twsu._coerce(datetime.date, '2024-02-29'),
+            datetime.date(2024, 2, 29))
+        eq_(twsu._coerce(datetime.datetime, '2024-02-29T10:20:30'),
+            datetime.datetime(2024, 2, 29, 10, 20, 30))
+        eq_(twsu._coerce(datetime.time, '10:20'), datetime.time(10, 20))
+        for python_type, value in [(bool, 'maybe'), (bool, 2),
+                                   (datetime.date, '29/02/2024'),
+                                   (int, 'x')]:
+            try:
+                twsu._coerce(python_type, value)
+                assert(False)
+            except ValueError:
+                pass
+
+    def test_from_dict_changes(self):
+        e = self.DBTestCls1.query.get(1)
+        changes = set()
+        twsu.from_dict(e, {'name': 'bar', 'some_number': 2}, changes=changes)
+        eq_(changes, set(['name']))
+        self.session.flush()
+        eq_(e.name, 'bar')
+
+    def test_from_dict_changes_nested(self):
+        e = self.DBTestCls1.query.get(1)
+        changes = set()
+        twsu.from_dict(e, {'others': [{'id': 1, 'nick': 'bob'},
+                                      {'nick': 'alice'}]}, changes=changes)
+        eq_(changes, set(['others', 'others.nick']))
+        changes = set()
+        twsu.from_dict(e, {'others': [{'id': 1, 'nick': 'bob'}]},
+                       changes=changes)
+        eq_(changes, set(['others']))
+
+    def test_from_dict_many_to_many_diff(self):
+        editor = self.DBTestCls4(id=2, rolename='editor')
+        viewer = self.DBTestCls4(id=3, rolename='viewer')
+        self.session.add_all([editor, viewer])
+        self.session.flush()
+        eq_(viewer.users, [])
+        u = self.DBTestCls3.query.get(1)
+        changes = set()
+        twsu.from_dict(u, {'roles': [editor, viewer]}, changes=changes)
+        eq_(changes, set(['roles']))
+        # Neither the collection nor the related objects were loaded
+        state = sa.orm.attributes.instance_state(u)
+        assert('roles' not in state.dict)
+        assert('users' not in sa.orm.attributes.instance_state(viewer).dict)
+        eq_(sorted(r.id for r in u.roles), [2, 3])
+        eq_(viewer.users, [u])
+
+        self.session.expire(u)
+        changes = set()
+        twsu.from_dict(u, {'roles': [viewer, editor]}, changes=changes)
+        eq_(changes, set())
+        twsu.from_dict(u, {'roles': []}, changes=changes)
+        eq_(changes, set(['roles']))
+        transaction.commit()
+        eq_(self.DBTestCls3.query.get(1).roles, [])
+
+    def test_from_dict_many_to_many_loaded(self):
+        editor = self.DBTestCls4(id=2, rolename='editor')
+        self.session.add(editor)
+        u = self.DBTestCls3.query.get(1)
+        eq_(len(u.roles), 1)
+        twsu.from_dict(u, {'roles': [editor]})
+        eq_(u.roles, [editor])
+        assert(u in editor.users)
+
+    def test_apply_plan(self):
+        mapper = sa.orm.class_mapper(self.DBTestCls1)
+        plan = twsu.apply_plan(mapper, {'id': 1, 'name': 'foo', 'others': []})
+        eq_(sorted((key, kind) for key, prop, kind, t in plan),
+            [('id', twsu.PKEY), ('name', twsu.COLUMN),
+             ('others', twsu.COLLECTION)])
+        assert(twsu.apply_plan(mapper, ['others', 'id', 'name']) is plan)
+        other = sa.orm.class_mapper(self.DBTestCls2)
+        eq_([(key, kind) for key, prop, kind, t in
+             twsu.apply_plan(other, ['other'])], [('other', twsu.SCALAR)])
+
+    def test_apply_plan_new_property(self):
+        mapper = sa.orm.class_mapper(self.DBTestCls1)
+        plan = twsu.apply_plan(mapper, ['name'])
+        mapper.add_property('name', sa.orm.column_property(
+            mapper.local_table.c.name))
+        new_plan = twsu.apply_plan(mapper, ['name'])
+        assert(new_plan is not plan)
+        assert(new_plan[0][1] is mapper.get_property('name'))
+
+    def test_apply_plan_lru(self):
+        import itertools
+        mapper = sa.orm.class_mapper(self.DBTestCls1)
+        keys = ['id', 'name', 'some_number', 'others']
+        maxsize = twsu._apply_plans_maxsize
+        twsu._apply_plans_maxsize = 4
+        try:
+            plan = twsu.apply_plan(mapper, ['name'])
+            for n in range(1, 5):
+                for combination in itertools.combinations(keys, n):
+                    twsu.apply_plan(mapper, ['name'])
+                    twsu.apply_plan(mapper, combination)
+                    assert(len(mapper._tws_apply_plans) <= 4)
+            assert(twsu.apply_plan(mapper, ['name']) is plan)
+        finally:
+            twsu._apply_plans_maxsize = maxsize
+
+    def test_bulk_from_list_insert_keys(self):
+        # The inserted rows don't all have the same keys
+        counts = twsu.bulk_from_list(
+            self.DBTestCls1, [{'id': 1, 'name': 'foo'}, {'name': 'x'},
+                              {'name': 'y', 'some_number': 5}])
+        eq_(counts, (2, 1, 0))
+        eq_(sorted((o.name, o.some_number) for o in self.DBTestCls1.query),
+            [('foo', 2), ('x', 2), ('y', 5)])
+
+    def test_passive_delete(self):
+        mapper = lambda cls: sa.orm.class_mapper(cls)
+        # Only many-to-one relations
+        assert(twsu._passive_delete(mapper(self.DBTestCls2)))
+        # The ORM nulls the foreign keys of the others
+        assert(not twsu._passive_delete(mapper(self.DBTestCls1)))
+        # The ORM deletes the association rows
+        assert(not twsu._passive_delete(mapper(self.DBTestCls3)))
+
+    def test_from_list_force_delete(self):
+        george = self.DBTestCls2.query.get(2)
+        objects = self.DBTestCls2.query.all()
+        twsu.from_list(self.DBTestCls2, objects, [{'id': 1, 'nick': 'bob'}],
+                       force_delete=True)
+        eq_([o.id for o in objects], [1])
+        assert(george not in self.session)
+        eq_([o.id for o in self.DBTestCls2.query.all()], [1])
+
+    def test_from_list_force_delete_relation(self):
+        import warnings
+        foo = self.DBTestCls1.query.get(1)
+        george = self.DBTestCls2.query.get(2)
+        george.other = foo
+        self.session.flush()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            twsu.from_list(self.DBTestCls2, foo.others,
+                           [{'id': 1, 'nick': 'bob'}], force_delete=True)
+            self.session.flush()
+        eq_(caught, [])
+        eq_([o.id for o in foo.others], [1])
+        eq_([o.id for o in self.DBTestCls2.query.all()], [1])
+
+    def test_delete_by_pks_orm(self):
+        bob = self.DBTestCls2.query.get(1)
+        twsu.delete_by_pks(self.DBTestCls1, [(1,)])
+        self.session.flush()
+        eq_(self.DBTestCls1.query.count(), 0)
+        eq_(bob.other_id, None)
+
+    def test_from_dict_one_to_one_orphan(self):
+        self.session.add(self.DBTestCls5(id=2, account_name='account2'))
+        u = self.DBTestCls6.query.get(1)
+        twsu.from_dict(u, {'account': None})
+        # Only the old account is deleted
+        eq_([a.id for a in self.DBTestCls5.query], [2])
+
+    def test_from_list_one_to_one_orphans(self):
+        self.session.add_all([
+            self.DBTestCls5(id=2, account_name='account2'),
+            self.DBTestCls5(id=3, account_name='account3'),
+            self.DBTestCls6(id=2, name='bob2', account_id=2)])
+        self.session.flush()
+        users = self.DBTestCls6.query.order_by(self.DBTestCls6.id).all()
+        statements = []
+        def execute(conn, cursor, statement, parameters, context, many):
+            if statement.startswith('DELETE'):
+                statements.append(statement)
+        connection = self.session.connection(
+            mapper=sa.orm.class_mapper(self.DBTestCls5))
+        sa.event.listen(connection, 'before_cursor_execute', execute)
+        twsu.from_list(self.DBTestCls6, users,
+                       [{'id': 1, 'account': None},
+                        {'id': 2, 'account': None}])
+        self.session.flush()
+        eq_(len(statements), 1)
+        eq_([a.id for a in self.DBTestCls5.query], [3])
+        eq_([u.account_id for u in users], [None, None])
+
+    def test_bulk_upsert(self):
+        foo = self.DBTestCls1.query.get(1)
+        foo.some_number = 7
+        data = [{'id': 1, 'name': 'bar'}, {'id': 5, 'name': 'new'},
+                {'id': 6}, {'name': 'anon'}]
+        counts = twsu.bulk_from_list(self.DBTestCls1, data,
+                                     protect_prm_tamp=False, upsert=True)
+        eq_(counts, (1, 3, 0))
+        eq_(sorted((o.id, o.name, o.some_number)
+                   for o in self.DBTestCls1.query),
+            [(1, 'bar', 7), (5, 'new', 2), (6, None, 2), (7, 'anon', 2)])
+        counts = twsu.bulk_from_list(self.DBTestCls1, [{'id': 5}],
+                                     force_delete=True,
+                                     protect_prm_tamp=False, upsert=True)
+        eq_(counts, (0, 1, 3))
+        eq_([o.id for o in self.DBTestCls1.query], [5])
+
+    def test_bulk_upsert_protected(self):
+        try:
+            twsu.bulk_from_list(self.DBTestCls1, [{'id': 5}], upsert=True)
+            assert(False)
+        except ValueError:
+            pass
+
+    def test_upsert_compile(self):
+        from sqlalchemy.dialects import postgresql, mysql
+        table = sa.orm.class_mapper(self.DBTestCls1).local_table
+        stmt = twsu.Upsert(table, [table.c.id], [table.c.name])
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert(sql.startswith('INSERT INTO "Test" (id, name'))
+        assert(sql.endswith(
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name'))
+        stmt = twsu.Upsert(table, [table.c.id])
+        assert(str(stmt.compile(dialect=postgresql.dialect()))
+               .endswith('ON CONFLICT (id) DO NOTHING'))
+        try:
+            stmt.compile(dialect=mysql.dialect())
+            assert(False)
+        except sa.exc.CompileError:
+            pass
+
+    def test_relation_kind(self):
+        def prop(cls, key):
+            return sa.orm.class_mapper(cls).get_property(key)
+        expected = [
+            (self.DBTestCls1, 'others', 'onetomany'),
+            (self.DBTestCls2, 'other', 'manytoone'),
+            (self.DBTestCls3, 'roles', 'manytomany'),
+            (self.DBTestCls5, 'user', 'onetoone'),
+            (self.DBTestCls6, 'account', 'onetoone'),
+            (self.DBTestCls1, 'name', None),
+        ]
+        for cls, key, kind in expected:
+            p = prop(cls, key)
+            eq_(twsu.relation_kind(p), kind)
+            # Served from the cache the second time
+            eq_(twsu.relation_kind(p), kind)
+            eq_(twsu.is_onetoone(p), kind == 'onetoone')
+            eq_(twsu.is_manytoone(p), kind == 'manytoone')
+            eq_(twsu.is_onetomany(p), kind == 'onetomany')
+            eq_(twsu.is_manytomany(p), kind == 'manytomany')
+        eq_(prop(self.DBTestCls2, 'other')._tws_relation_kind, 'manytoone')
+
 
 #
 # From a design standpoint, it would be nice to make the tw2.sqla.utils
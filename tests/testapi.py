@@ -1,5 +1,6 @@
 """ Copied from tw2.core """
 
+import sqlalchemy as sa
 import tw2.core as twc
 import tw2.core.templating
 import tw2.core.testbase.base as tw2test
@@ -21,3 +22,25 @@ def request(requestid, mw=None):
     rl['middleware'] = mw
     return tw2test.request_local_tst()
 
+
+
+class QueryCounter(object):
+    """ Count the statements sent to the database by the given engine while
+    the counter is used as a context manager """
+
+    def __init__(self, engine):
+        self.count = 0
+        self.active = False
+        sa.event.listen(engine, 'before_cursor_execute', self.before_execute)
+
+    def before_execute(self, *args):
+        if self.active:
+            self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        self.active = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self.active = False
@@ -1,14 +1,59 @@
-from widgets import (
-    RelatedValidator, DbFormPage, DbListForm, DbListPage, DbLinkField, 
-    commit_veto, transactional_session,
-    DbSelectionField, DbSingleSelectField, DbCheckBoxList, DbRadioButtonList, DbCheckBoxTable,
-    DbSingleSelectLink, DbLabelField)
-from factory import (
-    WidgetPolicy, ViewPolicy, EditPolicy,
-    AutoTableForm, AutoViewGrid, AutoGrowingGrid,
-    AutoListPage, AutoListPageEdit,
-    AutoEditFieldSet, AutoViewFieldSet,
-    NoWidget, FactoryWidget)
-
-import utils
-import widgets
+"""SQLAlchemy database layer for ToscaWidgets 2.
+
+The public names are imported from the submodules on first access, so that
+importing `tw2.sqla.utils` alone does not load tw2.forms, tw2.dynforms and
+the transaction machinery.
+"""
+import sys, types
+
+_exports = {
+    'widgets': (
+        'RelatedValidator', 'RelatedItemValidator', 'DbFormPage',
+        'DbListForm', 'DbListPage', 'DbLinkField',
+        'commit_veto', 'transactional_session', 'read_only_session',
+        'routing_session', 'replica_reads', 'RoutingSession',
+        'OptionsCache', 'DbOptionsSearch', 'DbSelectionField',
+        'DbSingleSelectField', 'DbCheckBoxList', 'DbRadioButtonList',
+        'DbCheckBoxTable', 'DbSingleSelectLink', 'DbLabelField'),
+    'factory': (
+        'WidgetPolicy', 'ViewPolicy', 'EditPolicy',
+        'AutoTableForm', 'AutoViewGrid', 'AutoGrowingGrid',
+        'AutoListPage', 'AutoListPageEdit',
+        'AutoEditFieldSet', 'AutoViewFieldSet',
+        'NoWidget', 'FactoryWidget'),
+}
+
+_submodules = ('widgets', 'factory', 'utils', 'compat')
+
+# {public name: submodule}
+_lazy = dict((name, module) for module, names in _exports.items()
+             for name in names)
+
+__all__ = sorted(_lazy) + ['utils', 'widgets']
+
+
+class _LazyModule(types.ModuleType):
+    """The tw2.sqla module, loading the submodules of the public names on
+    first access
+    """
+
+    def __getattr__(self, name):
+        if name in _lazy:
+            value = getattr(getattr(self, _lazy[name]), name)
+        elif name in _submodules:
+            value = __import__(self.__name__ + '.' + name, fromlist=[name])
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy) | set(_submodules))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(
+    (k, v) for k, v in globals().items() if k not in ('_module',))
+# The globals of this module are cleared when it is collected
+_module._orig = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -2,6 +2,7 @@ import tw2.core as twc, tw2.forms as twf, sqlalchemy as sa, sys
 import sqlalchemy.types as sat, tw2.dynforms as twd
 from widgets import *
 from utils import (
+    relation_kind,
     is_relation,
     is_onetoone,
     is_manytomany,
@@ -9,54 +10,53 @@ from utils import (
     is_onetomany,
 )
 import compat
+import weakref
 
 
-try:
-    from itertools import product
-except ImportError:
-    # Python 2.5 support
-    def product(x, y):
-        for i in x:
-            for j in y:
-                yield (i,j)
+_relation_weights = {
+    'onetoone': 4,
+    'onetomany': 3,
+    'manytoone': 2,
+    'manytomany': 1,
+}
 
-def sort_properties(localname_from_relationname, localname_creation_order):
-    """Returns a function which will sort the SQLAlchemy properties
+def property_weight(prop, kinds=None):
+    """Returns the weight of the given SQLAlchemy property in the widgets
+    order: 0 for the columns, then many to many, many to one, one to many and
+    one to one relations. `kinds` is an optional dict of the relation kinds
+    by name, like MapperInfo.kinds, to avoid classifying the relation again.
     """
-    def sort_func(prop1, prop2):
-        """Sort the given SQLAlchemy properties
+    if kinds is not None:
+        return _relation_weights.get(kinds.get(prop.key), 0)
+    return _relation_weights.get(relation_kind(prop), 0)
 
-        Logic: 1) Column
-               2) many to many
-               3) one to one
+def property_sort_key(localname_from_relationname, localname_creation_order,
+                      kinds=None):
+    """Returns a function giving the sort key of a SQLAlchemy property
 
-        When a relation has a column on the local side, we put the relation at
-        the place of the column.
-        """
-        def get_weight(prop):
-            if is_onetoone(prop):
-                return 4
-            elif is_onetomany(prop):
-                return 3
-            elif is_manytoone(prop):
-                return 2
-            elif is_manytomany(prop):
-                return 1
-            return 0
-
-        weight1 = get_weight(prop1)
-        weight2 = get_weight(prop2)
-
-        res = cmp(weight1, weight2)
-        if res != 0:
-            return res
+    Logic: 1) Column
+           2) many to many
+           3) one to one
 
+    When a relation has a column on the local side, we put the relation at
+    the place of the column.
+    """
+    def sort_key(prop):
         # If the prop is a relation we try to use the db column creation order
-        key1 = localname_from_relationname.get(prop1.key, prop1.key)
-        key2 = localname_from_relationname.get(prop2.key, prop2.key)
-        creation_order1 = localname_creation_order.get(key1, prop1._creation_order)
-        creation_order2 = localname_creation_order.get(key2, prop2._creation_order)
-        return cmp(creation_order1, creation_order2)
+        key = localname_from_relationname.get(prop.key, prop.key)
+        creation_order = localname_creation_order.get(key, prop._creation_order)
+        return (property_weight(prop, kinds), creation_order)
+    return sort_key
+
+def sort_properties(localname_from_relationname, localname_creation_order):
+    """Returns a function which will sort the SQLAlchemy properties.
+
+    Kept for compatibility, sorting with property_sort_key is faster.
+    """
+    sort_key = property_sort_key(localname_from_relationname,
+                                 localname_creation_order)
+    def sort_func(prop1, prop2):
+        return cmp(sort_key(prop1), sort_key(prop2))
     return sort_func
 
 def required_widget(prop):
@@ -64,20 +64,10 @@ def required_widget(prop):
 
     Returns True if the widget corresponding to the given prop should be required
     """
-    is_nullable = lambda prop: sum([c.nullable for c in getattr(prop, 'columns', [])])
-
-    if not is_relation(prop):
-        if not is_nullable(prop):
-            return True
-        return False
-
-    if not is_manytoone(prop) and not is_onetoone(prop):
-        return False
-
-    localname = compat.local_name(prop)
-    # If the local field is required, the relation should be required
-    pkey = dict([(p.key, is_nullable(p)) for p in prop.parent.iterate_properties])
-    return not pkey.get(localname, True)
+    info = _mapper_infos.get(prop.parent)
+    if info is None or info.by_key.get(prop.key) is not prop:
+        info = mapper_info(prop.parent)
+    return info.required.get(prop.key, False)
 
 def get_reverse_property_name(prop):
     """Returns the reverse property name of the given prop
@@ -89,6 +79,105 @@ def get_reverse_property_name(prop):
     return list(prop._reverse_property)[0].key
     
     
+class MapperInfo(object):
+    """The introspection results of a mapper used to generate the widgets,
+    computed once by `mapper_info` and shared by all the AutoContainers.
+
+    `props`
+        The properties, in the mapper order.
+
+    `properties`
+        The properties, in the order of the generated widgets.
+
+    `sort_keys`
+        The sort key of each property by name, see property_sort_key.
+
+    `kinds`
+        The relation kind ('onetoone', 'manytoone', 'onetomany' or
+        'manytomany') by relation name.
+
+    `local_names`
+        The name of the local column by many-to-one/one-to-one relation name.
+
+    `fkey`
+        The many-to-one/one-to-one relation by local column name.
+
+    `by_key`
+        The properties by name.
+
+    `nullable`
+        True by column property name when one of its columns is nullable.
+
+    `required`
+        True by property name when its widget should be required, see
+        required_widget.
+
+    `reverse_names`
+        The reverse property name by many-to-many/one-to-one relation name.
+    """
+
+    def __init__(self, mapper):
+        self.props = list(mapper.iterate_properties)
+        self.by_key = dict((p.key, p) for p in self.props)
+        self.kinds = dict((p.key, relation_kind(p)) for p in self.props
+                          if is_relation(p))
+
+        self.local_names = dict(
+            (p.key, compat.local_name(p)) for p in self.props
+            if self.kinds.get(p.key) in ('manytoone', 'onetoone'))
+        self.fkey = dict((name, mapper.get_property(key))
+                         for key, name in self.local_names.items())
+        self.nullable = dict(
+            (p.key, bool(sum([getattr(c, 'nullable', True)
+                              for c in p.columns])))
+            for p in self.props if not is_relation(p) and
+            hasattr(p, 'columns'))
+        # A relation is required when its local column is not nullable
+        self.required = dict(
+            (p.key, not self.nullable.get(p.key, False)) for p in self.props
+            if not is_relation(p))
+        self.required.update(
+            (key, not self.nullable.get(name, True))
+            for key, name in self.local_names.items())
+        self.reverse_names = dict(
+            (p.key, get_reverse_property_name(p)) for p in self.props
+            if self.kinds.get(p.key) in ('manytomany', 'onetoone'))
+
+        creation_order = dict((p.key, p._creation_order)
+                              for p in self.props if not is_relation(p))
+        sort_key = property_sort_key(self.local_names, creation_order,
+                                     self.kinds)
+        self.sort_keys = dict((p.key, sort_key(p)) for p in self.props)
+        self.properties = sorted(self.props,
+                                 key=lambda p: self.sort_keys[p.key])
+
+
+_mapper_infos = weakref.WeakKeyDictionary()
+
+def mapper_info(mapper):
+    """Returns the MapperInfo of the given mapper (or mapped class).
+
+    The result is cached until the properties of the mapper change.
+    """
+    if not isinstance(mapper, sa.orm.Mapper):
+        mapper = sa.orm.class_mapper(mapper)
+    info = _mapper_infos.get(mapper)
+    # iterate_properties configures the pending mappers
+    if info is None or info.props != list(mapper.iterate_properties):
+        info = _mapper_infos[mapper] = MapperInfo(mapper)
+    return info
+
+def _forget_mapper(mapper, class_):
+    _mapper_infos.pop(mapper, None)
+
+sa.event.listen(sa.orm.Mapper, 'mapper_configured', _forget_mapper)
+
+
+# {(policy, column type class): (policy.type_widgets, (widget,) or None)}
+_type_widgets_cache = {}
+_no_match = object()
+
+
 class WidgetPolicy(object):
     """
     A policy object is used to generate widgets from SQLAlchemy properties.
@@ -121,6 +210,9 @@ class WidgetPolicy(object):
 
     `type_widgets`
         A dictionary mapping SQLAlchemy property types to the desired widget.
+        The most specific type of the column wins, a TypeDecorator falls back
+        to the types of its `impl`. The resolution is cached per policy and
+        type: assign a new dictionary rather than updating it in place.
 
     `default_widget`
         If the property does not match any of the other selectors, this is used.
@@ -130,6 +222,13 @@ class WidgetPolicy(object):
         Boolean. If True and tws_edit_link is defined as param on the class, we
         add a link to edit this object.
 
+    `eager_loaders`
+        A dictionary mapping the relation kinds ('manytoone', 'onetoone',
+        'onetomany' and 'manytomany') to the loader strategy used when the
+        pages fetch the rows: 'joined', 'subquery', 'selectin' (subquery on
+        the SQLAlchemy versions without it) or None to keep the lazy
+        loading.
+
     Alternatively, the `factory` method can be overriden to provide completely
     customised widget selection.
     """
@@ -143,6 +242,44 @@ class WidgetPolicy(object):
     default_widget = None
     hint_name = None
     add_edit_link = False
+    eager_loaders = {
+        'manytoone': 'joined',
+        'onetoone': 'joined',
+        'onetomany': 'selectin',
+        'manytomany': 'selectin',
+    }
+
+    @classmethod
+    def eager_loader(cls, prop):
+        """Returns the name of the loader strategy to use for the given
+        relation, or None
+        """
+        return cls.eager_loaders.get(relation_kind(prop))
+
+    @classmethod
+    def type_widget(cls, type_, default=None):
+        """Returns the widget of type_widgets for the given column type, or
+        default if there is none
+        """
+        key = (cls, type_.__class__)
+        entry = _type_widgets_cache.get(key)
+        if entry is None or entry[0] is not cls.type_widgets:
+            entry = (cls.type_widgets, cls._resolve_type(type_))
+            _type_widgets_cache[key] = entry
+        if entry[1] is None:
+            return default
+        return entry[1][0]
+
+    @classmethod
+    def _resolve_type(cls, type_):
+        # Returns a (widget,) tuple or None
+        while isinstance(type_, sat.TypeEngine):
+            for t in type_.__class__.__mro__:
+                if t in cls.type_widgets:
+                    return (cls.type_widgets[t],)
+            # Look at the underlying type of a TypeDecorator
+            type_ = getattr(type_, 'impl', None)
+        return None
 
     @classmethod
     def factory(cls, prop):
@@ -223,9 +360,9 @@ class WidgetPolicy(object):
         elif prop.key in cls.name_widgets:
             widget = cls.name_widgets[prop.key]
         else:
-            for t, c in product(cls.type_widgets, cols):
-                if isinstance(c.type, t):
-                    widget = cls.type_widgets[t]
+            for c in cols:
+                widget = cls.type_widget(c.type, _no_match)
+                if widget is not _no_match:
                     break
             else:
                 if not cls.default_widget:
@@ -304,6 +441,10 @@ class AutoContainer(twc.Widget):
     entity = twc.Param('SQLAlchemy mapped class to use', request_local=False)
     policy = twc.Param('WidgetPolicy to use')
 
+    # The (relation path, loader strategy) pairs of the relations displayed
+    # by the children, see DbPage.fetch_query.
+    eager_loads = []
+
     @classmethod
     def post_define(cls):
         if not getattr(cls, 'entity', None) and getattr(cls.parent, 'entity', None):
@@ -311,30 +452,18 @@ class AutoContainer(twc.Widget):
 
         if getattr(cls, 'entity', None) and not getattr(cls, '_auto_widgets', False):
             cls._auto_widgets = True
-            fkey = dict((compat.local_name(p), p)
-                        for p in sa.orm.class_mapper(cls.entity).iterate_properties
-                        if is_manytoone(p) or is_onetoone(p))
+            info = mapper_info(cls.entity)
 
             new_children = []
             used_children = set()
             orig_children = getattr(cls.child, 'children', [])
-            
-            mapper = sa.orm.class_mapper(cls.entity)
-            properties = mapper._props.values()
-            localname_from_relationname = dict((p.key, compat.local_name(p))
-                    for p in mapper.iterate_properties
-                    if is_manytoone(p) or is_onetoone(p))
-            localname_creation_order =  dict((p.key, p._creation_order)
-                    for p in mapper.iterate_properties
-                    if not is_relation(p))
-            
-            properties.sort(sort_properties(localname_from_relationname,
-                localname_creation_order))
+
             reverse_property_name = getattr(cls, 'reverse_property_name', None)
-            for prop in properties:
+            eager_loads = []
+            for prop in info.properties:
 
                 # Swap ids and objs
-                if fkey.get(prop.key):
+                if prop.key in info.fkey:
                     continue
 
                 if prop.key == reverse_property_name:
@@ -352,9 +481,18 @@ class AutoContainer(twc.Widget):
                         new_children.append(widget)
                     used_children.add(widget_name)
                 else:
-                    new_widget = cls.policy.factory(prop)
-                    if new_widget:
-                        new_children.append(new_widget)
+                    widget = cls.policy.factory(prop)
+                    if widget:
+                        new_children.append(widget)
+
+                if widget and is_relation(prop) and \
+                   not issubclass(widget, NoWidget):
+                    loader = cls.policy.eager_loader(prop)
+                    if loader:
+                        eager_loads.append((prop.key, loader))
+                        eager_loads.extend(
+                            (prop.key + '.' + path, l) for path, l in
+                            getattr(widget, 'eager_loads', []))
 
             edit_link = getattr(cls.entity, 'tws_edit_link', None)
             if cls.policy.add_edit_link and edit_link:
@@ -374,6 +512,7 @@ class AutoContainer(twc.Widget):
                         cls.required_children += [c]
                         c.validator.required = False
             cls.child = cls.child(children=new_children, entity=cls.entity)
+            cls.eager_loads = eager_loads
 
 
 class AutoTableForm(AutoContainer, twf.TableForm):
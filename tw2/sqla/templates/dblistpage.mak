@@ -5,6 +5,12 @@
 % if w.child:
 ${w.child.display() | n}\
 %endif
+% if w.prev_link:
+<a href="${w.prev_link}" class="prev">Previous</a>\
+%endif
+% if w.next_link:
+<a href="${w.next_link}" class="next">Next</a>\
+%endif
 % if w.newlink:
 ${w.newlink.display() | n}\
 %endif
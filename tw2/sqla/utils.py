@@ -1,103 +1,416 @@
-import sqlalchemy as sa
+import sqlalchemy as sa, sqlalchemy.orm
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+import decimal
+import datetime
+import itertools
 
 
 def is_relation(prop):
     return isinstance(prop, sa.orm.RelationshipProperty)
 
 
-def is_onetoone(prop):
-    if not is_relation(prop):
-        return False
+def relation_kind(prop):
+    """Returns the kind of the given relation: 'onetoone', 'manytoone',
+    'onetomany' or 'manytomany', or None if prop is not a relation.
 
-    if prop.direction == sa.orm.interfaces.ONETOMANY:
-        if not prop.uselist:
-            return True
+    The result is stored on the property once its mapper is configured.
+    """
+    try:
+        return prop._tws_relation_kind
+    except AttributeError:
+        pass
 
-    if prop.direction == sa.orm.interfaces.MANYTOONE:
+    if not is_relation(prop):
+        kind = None
+    elif prop.direction == sa.orm.interfaces.MANYTOMANY:
+        kind = 'manytomany'
+    elif prop.direction == sa.orm.interfaces.ONETOMANY:
+        kind = prop.uselist and 'onetomany' or 'onetoone'
+    else:
         lis = list(prop._reverse_property)
-        assert len(lis) == 1
-        if not lis[0].uselist:
-            return True
+        assert len(lis) <= 1
+        if lis and not lis[0].uselist:
+            kind = 'onetoone'
+        else:
+            kind = 'manytoone'
+
+    # The reverse property is only known once the mappers are configured
+    if getattr(prop.parent, 'configured', True):
+        prop._tws_relation_kind = kind
+    return kind
 
-    return False
+
+def is_onetoone(prop):
+    return relation_kind(prop) == 'onetoone'
 
 
 def is_manytomany(prop):
-    return is_relation(prop) and \
-            prop.direction == sa.orm.interfaces.MANYTOMANY
+    return relation_kind(prop) == 'manytomany'
 
 
 def is_manytoone(prop):
-    if not is_relation(prop):
-        return False
+    return relation_kind(prop) == 'manytoone'
 
-    if not prop.direction == sa.orm.interfaces.MANYTOONE:
-        return False
 
-    if is_onetoone(prop):
+def is_onetomany(prop):
+    return relation_kind(prop) == 'onetomany'
+
+
+_numeric_types = (int, long, float, decimal.Decimal)
+_true_strings = ('1', 'true', 'yes', 'on')
+_false_strings = ('0', 'false', 'no', 'off', '')
+_time_formats = {
+    datetime.date: ('%Y-%m-%d',),
+    datetime.datetime: ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                        '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                        '%Y-%m-%d %H:%M', '%Y-%m-%d'),
+    datetime.time: ('%H:%M:%S.%f', '%H:%M:%S', '%H:%M'),
+}
+
+def _column_type(prop):
+    """Returns the python type the submitted values are converted to before
+    the comparison with the loaded value of prop, or None
+    """
+    if len(prop.columns) != 1:
+        return None
+    try:
+        python_type = prop.columns[0].type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+    if python_type in _numeric_types or python_type is bool or \
+       python_type in _time_formats:
+        return python_type
+    return None
+
+
+def _coerce(python_type, value):
+    """Returns the submitted value converted to python_type, as returned by
+    _column_type. Raises ValueError if it can't be converted.
+    """
+    if python_type is bool:
+        if isinstance(value, basestring):
+            text = value.strip().lower()
+            if text in _true_strings:
+                return True
+            if text in _false_strings:
+                return False
+        elif isinstance(value, (int, long)) and value in (0, 1):
+            return bool(value)
+        raise ValueError(value)
+    if python_type in _numeric_types:
+        if isinstance(value, (basestring, bool)):
+            try:
+                return python_type(value)
+            except decimal.InvalidOperation:
+                raise ValueError(value)
+        return value
+    if isinstance(value, basestring):
+        for format in _time_formats[python_type]:
+            try:
+                parsed = datetime.datetime.strptime(value.strip(), format)
+            except ValueError:
+                continue
+            if python_type is datetime.date:
+                return parsed.date()
+            if python_type is datetime.time:
+                return parsed.time()
+            return parsed
+        raise ValueError(value)
+    return value
+
+
+# The kinds of the steps of the apply plans
+COLUMN, SCALAR, COLLECTION, PKEY = 'column', 'scalar', 'collection', 'pkey'
+
+# The plans of a mapper are kept on the mapper, in a
+# {frozenset of keys: [tick, plan]} dict, so that they go away with it
+_apply_plans_attr = '_tws_apply_plans'
+_apply_plans_maxsize = 256
+_apply_plans_tick = itertools.count()
+
+
+def apply_plan(mapper, keys):
+    """Returns the plan to apply data with the given keys to the objects of
+    mapper: a list of (key, property, kind, column python type) tuples, the
+    kind being COLUMN, SCALAR (relation), COLLECTION (relation) or PKEY
+    (column never written).
+
+    The plans are cached per mapper until its properties change, the least
+    recently used are dropped first.
+    """
+    plans = mapper.__dict__.get(_apply_plans_attr)
+    if plans is None:
+        plans = {}
+        setattr(mapper, _apply_plans_attr, plans)
+    keys = frozenset(keys)
+    entry = plans.get(keys)
+    if entry is not None:
+        entry[0] = _apply_plans_tick.next()
+        return entry[1]
+
+    pk_props = set(p.key for p in mapper.primary_key)
+    plan = []
+    for key in keys:
+        prop = mapper.get_property(key)
+        python_type = None
+        if is_relation(prop):
+            kind = prop.uselist and COLLECTION or SCALAR
+        elif key in pk_props:
+            kind = PKEY
+        else:
+            kind = COLUMN
+            if hasattr(prop, 'columns'):
+                python_type = _column_type(prop)
+        plan.append((key, prop, kind, python_type))
+
+    if len(plans) >= _apply_plans_maxsize:
+        # Drop the least recently used quarter
+        ticks = sorted(e[0] for e in plans.values())
+        limit = ticks[len(ticks) // 4]
+        for k, e in plans.items():
+            if e[0] <= limit:
+                plans.pop(k, None)
+    plans[keys] = [_apply_plans_tick.next(), plan]
+    return plan
+
+
+def _forget_plans(mapper, class_):
+    mapper.__dict__.pop(_apply_plans_attr, None)
+
+def _forget_class_plans(cls, key, inst):
+    # A property added to a configured mapper is inherited by the mappers of
+    # the subclasses
+    classes = [cls]
+    while classes:
+        klass = classes.pop()
+        manager = sa.orm.instrumentation.manager_of_class(klass)
+        if manager is not None and manager.is_mapped:
+            _forget_plans(manager.mapper, klass)
+        classes.extend(klass.__subclasses__())
+
+sa.event.listen(sa.orm.Mapper, 'mapper_configured', _forget_plans)
+sa.event.listen(object, 'attribute_instrument', _forget_class_plans,
+                propagate=True)
+
+
+def _unchanged(obj, dict_, key, kind, python_type, value):
+    """Returns True if value is the loaded value of the key attribute of obj,
+    dict_ being the dict of its state
+    """
+    if kind == COLLECTION:
+        # The collection is loaded anyway to be replaced
+        if not isinstance(value, (list, tuple, set)):
+            return False
+        current = getattr(obj, key)
+        return len(current) == len(value) and \
+            set(map(id, current)) == set(map(id, value))
+    if key not in dict_:
         return False
+    current = dict_[key]
+    if kind == SCALAR or current is None or value is None:
+        return current is value
+    if python_type is not None:
+        try:
+            value = _coerce(python_type, value)
+        except ValueError:
+            return False
+    return current == value
+
+
+def _secondary_values(mapper, obj, pairs):
+    """Returns the values of the columns of obj referenced by the
+    association table columns of pairs
+    """
+    return tuple(getattr(obj, mapper.get_property_by_column(c).key)
+                 for c, sc in pairs)
 
-    return True
 
+def _diff_secondary(obj, state, prop, value, batch_size=500):
+    """
+    Replace the unloaded many-to-many collection prop of the persistent obj
+    with the list of persistent objects value, by diffing the rows of the
+    association table instead of loading the collection.
 
-def is_onetomany(prop):
-    if not is_relation(prop):
+    Returns None if the collection has to be set through the ORM, else
+    whether the association rows changed.
+    """
+    session = sa.orm.object_session(obj)
+    if prop.secondary is None or prop.viewonly or \
+       not isinstance(prop.secondary, sa.Table) or \
+       prop.key in state.dict or state.key is None or session is None or \
+       prop.lazy == 'dynamic' or \
+       prop.key in getattr(state, '_pending_mutations', ()):
+        return None
+    for v in value:
+        if sa.orm.attributes.instance_state(v).key is None:
+            return None
+
+    session.flush()
+    table = prop.secondary
+    parent = [sc for c, sc in prop.synchronize_pairs]
+    child = [sc for c, sc in prop.secondary_synchronize_pairs]
+    parent_values = _secondary_values(prop.parent, obj, prop.synchronize_pairs)
+    match = sa.and_(*[c == v for c, v in zip(parent, parent_values)])
+    current = set(tuple(r) for r in session.execute(
+        sa.select(child, match), mapper=prop.parent))
+    submitted = dict(
+        (_secondary_values(prop.mapper, v, prop.secondary_synchronize_pairs), v)
+        for v in value)
+    added = [k for k in submitted if k not in current]
+    removed = [k for k in current if k not in submitted]
+    if not added and not removed:
         return False
 
-    if not prop.direction == sa.orm.interfaces.ONETOMANY:
-        return False
+    def execute(statement, params):
+        for i in xrange(0, len(params), batch_size):
+            session.execute(statement, params[i:i + batch_size],
+                            mapper=prop.parent)
+
+    def row(values):
+        row = dict((c.key, v) for c, v in zip(parent, parent_values))
+        row.update((c.key, v) for c, v in zip(child, values))
+        return row
+
+    if added:
+        execute(table.insert(), [row(k) for k in added])
+    if removed:
+        execute(table.delete().where(sa.and_(
+            *[c == sa.bindparam(c.key) for c in parent + child])),
+            [row(k) for k in removed])
+
+    # The loaded collections on the other side are stale
+    reverse = [p.key for p in prop._reverse_property]
+    related = [submitted[k] for k in added]
+    referenced = [c for c, sc in prop.secondary_synchronize_pairs]
+    if set(referenced) == set(prop.mapper.primary_key):
+        order = [referenced.index(c) for c in prop.mapper.primary_key]
+        for k in removed:
+            o = session.identity_map.get(
+                prop.mapper.identity_key_from_primary_key(
+                    [k[i] for i in order]))
+            if o is not None:
+                related.append(o)
+    for o in related:
+        loaded = [k for k in reverse
+                  if k in sa.orm.attributes.instance_state(o).dict]
+        if loaded:
+            session.expire(o, loaded)
+    return True
 
-    if is_onetoone(prop):
-        return False
 
-    return True
+def _delete_orphans(orphans):
+    """Delete the objects of orphans, {entity: [objects]}, with one
+    statement per entity when the ORM has nothing to cascade
+    """
+    for entity, objects in orphans.items():
+        session = entity.query.session
+        pks = []
+        for o in objects:
+            state = sa.orm.attributes.instance_state(o)
+            if state.key is None:
+                # Never flushed, nothing to delete
+                if o in session:
+                    session.expunge(o)
+            elif not _passive_delete(state.mapper):
+                session.delete(o)
+            else:
+                pks.append(state.key[1])
+        if pks:
+            # The references to the rows are cleared first
+            session.flush()
+            delete_by_pks(entity, pks)
 
 
-def from_dict(obj, data, protect_prm_tamp=True):
+def from_dict(obj, data, protect_prm_tamp=True, changes=None,
+              _orphans=None):
     """
     Update a mapped object with data from a JSON-style nested dict/list
     structure.
 
     To protect against parameter tampering attacks, primary key fields are
     never overwritten.
-    """
-    mapper = sa.orm.object_mapper(obj)
-    pk_props = set(p.key for p in mapper.primary_key)
 
-    for key, value in data.iteritems():
-        prop = mapper.get_property(key)
+    The attributes whose loaded value equals the submitted one are not
+    written. If a set is given as `changes`, the names of the attributes
+    which were written are added to it, as 'relation.attribute' for the
+    nested ones.
+
+    An unloaded many-to-many collection of a persistent object is not loaded
+    to be replaced: the added and removed rows of the association table are
+    computed with one query and written with INSERT and DELETE statements,
+    the ORM events of the collection are not triggered.
+
+    The old value of a one-to-one relation set to None is deleted, by the
+    delete-orphan cascade if the relation has one, else by primary key once
+    the object is updated.
+    """
+    plan = apply_plan(sa.orm.object_mapper(obj), data)
+    state = sa.orm.attributes.instance_state(obj)
+    dict_ = state.dict
+    if changes is None:
+        changes = set()
+    orphans = _orphans
+    if orphans is None:
+        orphans = {}
+
+    for key, prop, kind, python_type in plan:
+        value = data[key]
         if isinstance(value, dict):
             if hasattr(obj, key):
                 record = getattr(obj, key)
                 if not record:
                     record = prop.mapper.class_()
                     setattr(obj, key, record)
-                from_dict(record, value, protect_prm_tamp)
+                    changes.add(key)
+                nested = set()
+                from_dict(record, value, protect_prm_tamp, nested, orphans)
+                changes.update(key + '.' + k for k in nested)
             else:
                 # Just discard the data.  Necessary in the event that someone
                 # is using tw2.captcha in their tw2.sqla form.
                 pass
         elif isinstance(value, list) and \
              value and isinstance(value[0], dict):
+            objects = getattr(obj, key)
+            before = map(id, objects)
+            nested = set()
             from_list(
                 prop.mapper.class_,
-                getattr(obj, key),
+                objects,
                 value,
-                protect_prm_tamp=protect_prm_tamp
+                protect_prm_tamp=protect_prm_tamp,
+                changes=nested,
+                _orphans=orphans,
             )
-        elif key not in pk_props:
+            if nested or before != map(id, objects):
+                changes.add(key)
+            changes.update(key + '.' + k for k in nested)
+        elif kind != PKEY:
+            if kind == COLLECTION and isinstance(value, list):
+                diffed = _diff_secondary(obj, state, prop, value)
+                if diffed is not None:
+                    if diffed:
+                        changes.add(key)
+                    continue
+            if _unchanged(obj, dict_, key, kind, python_type, value):
+                continue
             if value is None:
                 old_v = getattr(obj, key, None)
-                if is_onetoone(prop) and old_v is not None:
-                    # Delete the old value from the DB
-                    old_v.query.delete()
+                if kind == SCALAR and old_v is not None and \
+                   is_onetoone(prop) and not prop.cascade.delete_orphan:
+                    orphans.setdefault(prop.mapper.class_, []).append(old_v)
             setattr(obj, key, value)
+            changes.add(key)
 
+    if _orphans is None and orphans:
+        _delete_orphans(orphans)
     return obj
 
 
 def from_list(entity, objects, data,
-              force_delete=False, protect_prm_tamp=True):
+              force_delete=False, protect_prm_tamp=True, changes=None,
+              _orphans=None):
     """
     Update a list of mapped objects with data from a JSON-style nested
     dict/list structure.
@@ -105,9 +418,16 @@ def from_list(entity, objects, data,
     To protect against parameter tampering attacks, if the primary key field(s)
     for a row do not exactly match an existing object then a new object is
     created.
+
+    If a set is given as `changes`, the names of the attributes written on
+    the rows are added to it, see from_dict. The one-to-one values cleared
+    on the rows are deleted together, see from_dict.
     """
 
     mapper = sa.orm.class_mapper(entity)
+    orphans = _orphans
+    if orphans is None:
+        orphans = {}
     pkey_fields = [f.key for f in mapper.primary_key]
     obj_map = dict(
         (tuple(mapper.primary_key_from_instance(o)), o) for o in objects
@@ -121,27 +441,58 @@ def from_list(entity, objects, data,
         obj = obj_map.pop(pkey, None)
         if not obj and protect_prm_tamp:
             obj = entity()
-            from_dict(obj, row, protect_prm_tamp)
+            from_dict(obj, row, protect_prm_tamp, changes, orphans)
             obj.query.session.add(obj)
             objects.append(obj)
         elif not obj:
-            obj = update_or_create(entity, row)
+            obj = update_or_create(entity, row, changes=changes,
+                                   _orphans=orphans)
             obj.query.session.add(obj)
             objects.append(obj)
         else:
-            from_dict(obj, row, protect_prm_tamp)
-
-    for d in obj_map.values():
-        objects.remove(d)
-        if force_delete:
-            # Only fully delete 'unreferenced' objects if explicitly told to do
-            # so.  You would *not* want to do this in a database of friends
-            # where sally and suzie stop being friends but you do not want
-            # suzie deleted from the database alltogether.
-            d.query.session.delete(d)
+            from_dict(obj, row, protect_prm_tamp, changes, orphans)
+    if _orphans is None and orphans:
+        _delete_orphans(orphans)
+
+    leftovers = obj_map.values()
+    if not leftovers:
+        return
+    if isinstance(objects, list):
+        # One pass instead of a list.remove per leftover
+        gone = set(map(id, leftovers))
+        for i in xrange(len(objects) - 1, -1, -1):
+            if id(objects[i]) in gone:
+                del objects[i]
+    else:
+        for d in leftovers:
+            objects.remove(d)
+    if force_delete:
+        # Only fully delete 'unreferenced' objects if explicitly told to do
+        # so.  You would *not* want to do this in a database of friends
+        # where sally and suzie stop being friends but you do not want
+        # suzie deleted from the database alltogether.
+        session = entity.query.session
+        flushed = []
+        for d in leftovers:
+            state = sa.orm.attributes.instance_state(d)
+            if state.key is None:
+                # Never flushed, nothing to delete
+                session.expunge(d)
+            else:
+                flushed.append(d)
+        if sa.orm.collections.collection_adapter(objects) is None and \
+           _passive_delete(mapper):
+            delete_by_pks(entity, [sa.orm.attributes.instance_state(d).key[1]
+                                   for d in flushed])
+        else:
+            # The flush of a relation collection processes the removed
+            # objects, which must still be in the session then.
+            for d in flushed:
+                session.delete(d)
 
 
-def update_or_create(cls, data, protect_prm_tamp=True):
+def update_or_create(cls, data, protect_prm_tamp=True, changes=None,
+                     _orphans=None):
 
     try:
         session = cls.query.session
@@ -159,5 +510,313 @@ def update_or_create(cls, data, protect_prm_tamp=True):
         record = cls()
         session.add(record)
 
-    record = from_dict(record, data, protect_prm_tamp)
+    record = from_dict(record, data, protect_prm_tamp, changes, _orphans)
     return record
+
+
+def _pk_keys(mapper):
+    return [mapper.get_property_by_column(c).key for c in mapper.primary_key]
+
+
+def _pk_clause(mapper, pks):
+    """Returns the SQL clause matching the given primary key tuples
+    """
+    columns = mapper.primary_key
+    if len(columns) == 1:
+        return columns[0].in_([pk[0] for pk in pks])
+    return sa.or_(*[sa.and_(*[c == v for c, v in zip(columns, pk)])
+                    for pk in pks])
+
+
+def query_by_pks(entity, pks, query=None, chunk_size=500):
+    """Returns the objects of query (all the objects of entity by default)
+    whose primary key is one of the given tuples, loaded in chunks
+    """
+    mapper = sa.orm.class_mapper(entity)
+    if query is None:
+        query = entity.query
+    pks = list(pks)
+    objects = []
+    for i in xrange(0, len(pks), chunk_size):
+        objects.extend(query.filter(_pk_clause(mapper, pks[i:i + chunk_size])))
+    return objects
+
+
+def query_pks(entity, query=None):
+    """Returns the set of the primary key tuples of the rows of query (all
+    the rows of entity by default), without loading the objects
+    """
+    if query is None:
+        query = entity.query
+    attrs = [getattr(entity, k) for k in _pk_keys(sa.orm.class_mapper(entity))]
+    return set(tuple(r) for r in query.with_entities(*attrs))
+
+
+def _passive_delete(mapper):
+    """Returns True if the rows of mapper can be deleted with a DELETE
+    statement, the ORM having nothing to cascade to the other rows
+    """
+    if mapper.inherits is not None or mapper.polymorphic_on is not None or \
+       mapper.version_id_col is not None:
+        return False
+    for prop in mapper.iterate_properties:
+        if not is_relation(prop) or prop.viewonly:
+            continue
+        if prop.direction == sa.orm.interfaces.MANYTOONE:
+            if prop.cascade.delete:
+                return False
+        elif not prop.passive_deletes:
+            # The ORM would delete or update the related rows
+            return False
+    return True
+
+
+def delete_by_pks(entity, pks, chunk_size=500):
+    """
+    Delete the rows of entity whose primary key is one of the given tuples.
+
+    When the ORM has nothing to cascade (the relations are many-to-one
+    without delete cascade, or have passive_deletes), the rows are deleted
+    with DELETE ... WHERE pk IN (...) statements and the loaded objects are
+    expunged from the session; the mapper delete events are not triggered,
+    the session after_bulk_delete one is. Otherwise the objects are loaded
+    and deleted through the session.
+    """
+    mapper = sa.orm.class_mapper(entity)
+    session = entity.query.session
+    pks = list(pks)
+    if not pks:
+        return
+    if not _passive_delete(mapper):
+        for obj in query_by_pks(entity, pks, chunk_size=chunk_size):
+            session.delete(obj)
+        return
+
+    for pk in pks:
+        obj = session.identity_map.get(
+            mapper.identity_key_from_primary_key(list(pk)))
+        if obj is not None:
+            session.expunge(obj)
+    for i in xrange(0, len(pks), chunk_size):
+        entity.query.filter(_pk_clause(mapper, pks[i:i + chunk_size])) \
+            .delete(synchronize_session=False)
+
+
+def update_list(entity, data, query=None, force_delete=False,
+                protect_prm_tamp=True, changes=None):
+    """
+    Update the rows of query (all the objects of entity by default) with a
+    JSON-style list of rows, like from_list, loading only the submitted
+    objects.
+
+    The rows whose primary key is not in query are created, following the
+    parameter tampering protection of from_list. With force_delete, the rows
+    of query which were not submitted are deleted. The changes are collected
+    in `changes` like with from_dict.
+    """
+    mapper = sa.orm.class_mapper(entity)
+    pk_keys = _pk_keys(mapper)
+    for row in data:
+        if not isinstance(row, dict):
+            raise Exception(
+                    'Cannot send mixed (dict/non dict) data '
+                    'to list relationships in from_dict data.')
+    submitted = set(tuple(row.get(k) for k in pk_keys) for row in data)
+    submitted.discard(tuple(None for k in pk_keys))
+
+    missing = ()
+    if force_delete:
+        # Before the new objects get flushed
+        missing = query_pks(entity, query) - submitted
+    objects = query_by_pks(entity, submitted, query)
+    from_list(entity, objects, data, protect_prm_tamp=protect_prm_tamp,
+              changes=changes)
+    delete_by_pks(entity, missing)
+
+
+def _bulk_columns(mapper, keys):
+    """Returns the column of each key, or None if the rows can't be applied
+    with bulk statements on the table of mapper
+    """
+    if mapper.inherits is not None or mapper.polymorphic_on is not None:
+        return None
+    columns = {}
+    for key, prop, kind, python_type in apply_plan(mapper, keys):
+        if kind not in (COLUMN, PKEY) or len(prop.columns) != 1 or \
+           getattr(prop.columns[0], 'table', None) is not mapper.local_table:
+            return None
+        columns[key] = prop.columns[0]
+    return columns
+
+
+class Upsert(Insert):
+    """INSERT ... ON CONFLICT (index) DO UPDATE of the update columns with the
+    inserted values, or DO NOTHING without update columns. Supported by
+    SQLite (3.24+) and PostgreSQL (9.5+), see `upsert_dialects`.
+    """
+
+    def __init__(self, table, index, update=()):
+        super(Upsert, self).__init__(table)
+        self.index = list(index)
+        self.update = list(update)
+
+
+upsert_dialects = ('sqlite', 'postgresql')
+
+
+@compiles(Upsert)
+def _compile_upsert_default(element, compiler, **kw):
+    raise sa.exc.CompileError(
+        "ON CONFLICT is not supported by the %s dialect"
+        % compiler.dialect.name)
+
+
+@compiles(Upsert, 'sqlite')
+@compiles(Upsert, 'postgresql')
+def _compile_upsert(element, compiler, **kw):
+    quote = compiler.preparer.format_column
+    text = compiler.visit_insert(element, **kw)
+    text += ' ON CONFLICT (%s)' % ', '.join(quote(c) for c in element.index)
+    if not element.update:
+        return text + ' DO NOTHING'
+    return text + ' DO UPDATE SET ' + ', '.join(
+        '%s = excluded.%s' % (quote(c), quote(c)) for c in element.update)
+
+
+def bulk_from_list(entity, data, force_delete=False, protect_prm_tamp=True,
+                   batch_size=500, query=None, upsert=False):
+    """
+    Update the rows of query (all the rows of entity by default) with a
+    JSON-style list of rows, like update_list, using batches of INSERT,
+    UPDATE and DELETE statements instead of loading the objects.
+
+    The rows whose primary key matches a row of query are updated, the other
+    ones are inserted, following the same parameter tampering protection as
+    from_list. With force_delete, the rows of query which were not submitted
+    are deleted.
+
+    No ORM event is triggered, and the loaded objects of entity are expired
+    (or expunged if deleted). Rows with relations, and entities mapped with
+    inheritance, are applied with update_list instead.
+
+    With upsert, the rows having a primary key are written with INSERT ...
+    ON CONFLICT DO UPDATE statements (see Upsert) instead of being looked up
+    first, so the rows whose primary key is not in the table are created
+    with it: this needs protect_prm_tamp=False. The rows out of query are
+    updated too, query only restricts force_delete. On the other dialects,
+    the rows are looked up and the missing ones are inserted with their
+    primary key.
+
+    Returns the numbers of inserted, updated and deleted rows, or None if
+    update_list was used; with upsert, the upserted rows are counted as
+    updated.
+    """
+    if upsert and protect_prm_tamp:
+        raise ValueError("upsert creates the rows with the submitted primary "
+                         "keys, it needs protect_prm_tamp=False")
+    mapper = sa.orm.class_mapper(entity)
+    session = entity.query.session
+
+    keys = set()
+    for row in data:
+        if not isinstance(row, dict):
+            raise Exception(
+                    'Cannot send mixed (dict/non dict) data '
+                    'to list relationships in from_dict data.')
+        keys.update(row)
+    columns = _bulk_columns(mapper, keys)
+    if columns is None:
+        update_list(entity, data, query, force_delete=force_delete,
+                    protect_prm_tamp=protect_prm_tamp)
+        return None
+
+    pk_cols = mapper.primary_key
+    pk_keys = _pk_keys(mapper)
+
+    # Only the primary keys of the existing rows are loaded
+    session.flush()
+    on_conflict = upsert and \
+        session.get_bind(mapper).dialect.name in upsert_dialects
+    if force_delete:
+        existing = query_pks(entity, query)
+    elif on_conflict:
+        existing = set()
+    else:
+        if query is None:
+            query = entity.query
+        submitted = list(set(tuple(row.get(k) for k in pk_keys)
+                             for row in data))
+        existing = set()
+        for i in xrange(0, len(submitted), batch_size):
+            existing.update(query_pks(entity, query.filter(
+                _pk_clause(mapper, submitted[i:i + batch_size]))))
+
+    # {frozenset of column keys: [params]}, executemany needs the same keys
+    inserts = {}
+    updates = {}
+    upserts = {}
+    n_inserts = n_updates = 0
+    for row in data:
+        pkey = tuple(row.get(k) for k in pk_keys)
+        if on_conflict and [1 for v in pkey if v]:
+            existing.discard(pkey)
+            params = dict((columns[k].key, v) for k, v in row.iteritems())
+            upserts.setdefault(frozenset(params), []).append(params)
+            n_updates += 1
+        elif pkey in existing:
+            existing.discard(pkey)
+            params = dict(('_pk%d' % i, v) for i, v in enumerate(pkey))
+            params.update((columns[k].key, v) for k, v in row.iteritems()
+                          if k not in pk_keys)
+            updates.setdefault(frozenset(params), []).append(params)
+            n_updates += 1
+        elif protect_prm_tamp or not [1 for v in pkey if v]:
+            # Like from_dict, the primary key of a new row is never written
+            params = dict((columns[k].key, v) for k, v in row.iteritems()
+                          if k not in pk_keys)
+            inserts.setdefault(frozenset(params), []).append(params)
+            n_inserts += 1
+        elif upsert:
+            # On a dialect without ON CONFLICT
+            params = dict((columns[k].key, v) for k, v in row.iteritems())
+            inserts.setdefault(frozenset(params), []).append(params)
+            n_inserts += 1
+        else:
+            raise Exception("cannot create with pk")
+
+    table = mapper.local_table
+    pk_match = sa.and_(*[c == sa.bindparam('_pk%d' % i)
+                         for i, c in enumerate(pk_cols)])
+    pk_names = set(c.key for c in pk_cols)
+    def execute(statement, params):
+        for i in xrange(0, len(params), batch_size):
+            session.execute(statement, params[i:i + batch_size],
+                            mapper=mapper)
+
+    # Before the inserts, whose generated keys could take submitted ones
+    for keys, params in upserts.items():
+        update = [c for c in table.c if c.key in keys and
+                  c.key not in pk_names]
+        execute(Upsert(table, pk_cols, update), params)
+    for params in inserts.values():
+        execute(table.insert(), params)
+    for params in updates.values():
+        if len(params[0]) > len(pk_cols):
+            execute(table.update().where(pk_match), params)
+    deletes = []
+    if force_delete:
+        deletes = list(existing)
+        execute(table.delete().where(pk_match),
+                [dict(('_pk%d' % i, v) for i, v in enumerate(pkey))
+                 for pkey in deletes])
+
+    deleted = set(deletes)
+    for obj in session.identity_map.values():
+        if isinstance(obj, entity):
+            state = sa.orm.attributes.instance_state(obj)
+            if state.key[1] in deleted:
+                session.expunge(obj)
+            else:
+                session.expire(obj)
+
+    return n_inserts, n_updates, len(deletes)
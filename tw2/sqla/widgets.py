@@ -1,7 +1,30 @@
 import tw2.core as twc, tw2.forms as twf, webob, sqlalchemy as sa, sys
 import sqlalchemy.types as sat, tw2.dynforms as twd
-from zope.sqlalchemy import ZopeTransactionExtension
-import transaction, utils, urllib
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
+import transaction, utils, urllib, threading, time, json, weakref, contextlib
+import random, decimal
+
+
+def _related_cache():
+    """Returns the request-scoped cache of the objects resolved by the
+    related validators, keyed by (entity, primary key). Misses are cached as
+    None until the next flush.
+
+    Outside of a middleware request nothing clears the request local storage,
+    so a new, empty cache is returned each time.
+    """
+    rl = twc.core.request_local()
+    if 'middleware' not in rl:
+        return {}
+    return rl.setdefault('tw2.sqla.related_cache', {})
+
+def _forget_related_misses(session, flush_context):
+    cache = twc.core.request_local().get('tw2.sqla.related_cache')
+    if cache:
+        for key in [k for k, v in cache.items() if v is None]:
+            del cache[key]
+
+sa.event.listen(sa.orm.Session, 'after_flush', _forget_related_misses)
 
 
 class RelatedValidator(twc.IntValidator):
@@ -35,14 +58,35 @@ class RelatedValidator(twc.IntValidator):
         if isinstance(value, self.entity):
             return value
 
+        value = self.lookup(self.coerce(value))
+        if not value:
+            raise twc.ValidationError('norel', self)
+        return value
+
+    def lookup(self, value):
+        """Returns the object having the given primary key, or None.
+
+        The session identity map is checked before querying the database and
+        the result, found or not, is cached for the rest of the request.
+        """
+        cache = _related_cache()
+        key = (self.entity, value)
+        if key in cache:
+            obj = cache[key]
+            if obj is None or sa.orm.object_session(obj) is not None:
+                return obj
+        # Query.get looks in the identity map before emitting a SELECT
+        obj = self.entity.query.get(value)
+        cache[key] = obj
+        return obj
+
+    def coerce(self, value):
+        """Convert a submitted value to the type of the primary key column"""
         if isinstance(self.primary_key.type, sa.types.Integer):
             try:
-                value = int(value)
+                return int(value)
             except ValueError:
                 raise twc.ValidationError('norel', self)
-        value = self.entity.query.filter(getattr(self.entity, self.primary_key.name)==value).first()
-        if not value:
-            raise twc.ValidationError('norel', self)
         return value
 
     def from_python(self, value, state=None):
@@ -63,22 +107,100 @@ class RelatedItemValidator(twc.Validator):
         It must also have the SQLAlchemy `query` property; this will be the case for Elixir classes,
         and can be specified using DeclarativeBase (and is in the TG2 default setup).
 
+    `batch`
+        If True, all the submitted ids are loaded with a single `IN` query
+        (split in chunks of `chunk_size` ids) instead of one query per id.
+        The ids which are not found are reported with the `norel` message
+        instead of being silently dropped.
+
     This validator is used to make sure at least one value of the list is defined.
     """
+    msgs = {
+        'norel': RelatedValidator.msgs['norel'],
+    }
+    # Stay under the bind parameter limit of the drivers (999 for sqlite)
+    chunk_size = 500
 
-    def __init__(self, entity, required=False, **kw):
+    def __init__(self, entity, required=False, batch=False, **kw):
         super(RelatedItemValidator, self).__init__(**kw)
         self.required = required
         self.entity = entity
+        self.batch = batch
         self.item_validator = RelatedValidator(entity=self.entity)
 
     def to_python(self, value, state=None):
-        value = [twc.safe_validate(self.item_validator, v) for v in value]
-        value = [v for v in value if v is not twc.Invalid]
+        if self.batch:
+            value = self._batch_to_python(value)
+        else:
+            value = [twc.safe_validate(self.item_validator, v) for v in value]
+            value = [v for v in value if v is not twc.Invalid]
         if not value and self.required:
             raise twc.ValidationError('required', self)
         return value
 
+    def _batch_to_python(self, value):
+        """Returns the objects corresponding to the given ids, in the
+        submitted order, using one query per chunk of ids.
+        """
+        name = self.item_validator.primary_key.name
+        column = getattr(self.entity, name)
+
+        invalid = object()
+        ids = []
+        for v in value:
+            if not v:
+                continue
+            if isinstance(v, self.entity):
+                ids.append((v, v))
+                continue
+            try:
+                ids.append((v, self.item_validator.coerce(v)))
+            except twc.ValidationError:
+                ids.append((v, invalid))
+
+        cache = _related_cache()
+        wanted = []
+        seen = set()
+        for v, i in ids:
+            if i is invalid or isinstance(i, self.entity) or i in seen:
+                continue
+            seen.add(i)
+            if (self.entity, i) in cache:
+                obj = cache[(self.entity, i)]
+                if obj is None or sa.orm.object_session(obj) is not None:
+                    continue
+            wanted.append(i)
+
+        for start in range(0, len(wanted), self.chunk_size):
+            chunk = wanted[start:start + self.chunk_size]
+            found = dict((getattr(obj, name), obj) for obj in
+                         self.entity.query.filter(column.in_(chunk)))
+            for i in chunk:
+                cache[(self.entity, i)] = found.get(i)
+
+        objs = []
+        missing = []
+        reported = set()
+        for v, i in ids:
+            if isinstance(i, self.entity):
+                objs.append(i)
+            elif i is not invalid and cache[(self.entity, i)] is not None:
+                objs.append(cache[(self.entity, i)])
+            else:
+                m = i if i is not invalid else v
+                if m not in reported:
+                    reported.add(m)
+                    missing.append(m)
+
+        if missing:
+            msg = twc.ValidationError('norel', self).msg
+            e = twc.ValidationError(
+                u'%s: %s' % (msg, u', '.join(unicode(m) for m in missing)),
+                self)
+            e.missing = missing
+            raise e
+        return objs
+
     def from_python(self, value, state=None):
         return value
 
@@ -144,15 +266,74 @@ class RelatedOneToOneValidator(twc.Validator):
         return value
 
 
+_eager_loaders = {
+    'joined': sa.orm.joinedload,
+    'subquery': sa.orm.subqueryload,
+    # selectinload only exists since sqlalchemy 1.2
+    'selectin': getattr(sa.orm, 'selectinload', sa.orm.subqueryload),
+}
+
+
 class DbPage(twc.Page):
+    """
+    Base of the pages with database synchronisation.
+
+    With `read_only`, the GET requests are served from a read-only session
+    which is closed once the page is rendered, instead of taking part in the
+    zope transaction (see `read_only_session`).
+
+    The GET requests read from the replicas when the entity uses a
+    `routing_session`; the POST requests use the primary database.
+    """
     entity = twc.Param('SQLAlchemy mapped class to use', request_local=False,
                        default=None)
+    read_only = twc.Param('Serve the GET requests from a read-only session',
+                          request_local=False, default=False)
     _no_autoid = True
     @classmethod
     def post_define(cls):
         if getattr(cls, 'entity', None) and not hasattr(cls, 'title'):
             cls.title = twc.util.name2label(cls.entity.__name__)
 
+    @classmethod
+    def request(cls, req):
+        if cls.entity is None:
+            return super(DbPage, cls).request(req)
+        if req.method not in ('GET', 'HEAD'):
+            # Record the writes of the request in a cookie, so that the next
+            # requests of the client read from the primary
+            previous = getattr(_replica_local, 'last_write', 0)
+            _replica_local.last_write = 0
+            try:
+                resp = super(DbPage, cls).request(req)
+                # Without do_commit (see validated_request), the changes are
+                # flushed by the commit, after the response is built
+                session = cls.entity.query.session
+                if isinstance(session, RoutingSession):
+                    session.flush()
+                written = _replica_local.last_write
+            finally:
+                _replica_local.last_write = previous
+            if written:
+                resp.set_cookie(write_cookie, '%.3f' % written, path='/')
+            return resp
+        with replica_reads(_client_write(req)):
+            if cls.read_only:
+                with read_only_session(cls.entity):
+                    return super(DbPage, cls).request(req)
+            return super(DbPage, cls).request(req)
+
+    def fetch_query(self, query=None):
+        """Returns the query used by fetch_data, `query` or all the rows of
+        the entity. The relations displayed by the child, as recorded in its
+        `eager_loads` by AutoContainer, are eagerly loaded.
+        """
+        if query is None:
+            query = self.entity.query
+        options = [_eager_loaders[loader](path) for path, loader in
+                   getattr(self.child, 'eager_loads', [])]
+        return query.options(*options)
+
 class DbFormPage(DbPage, twf.FormPage):
     """
     A page that contains a form with database synchronisation. The `fetch_data` method loads a record
@@ -167,15 +348,21 @@ class DbFormPage(DbPage, twf.FormPage):
         data = req.GET.mixed()
         filter = dict((col.name, data.get(col.name))
                         for col in sa.orm.class_mapper(self.entity).primary_key)
-        self.value = req.GET and self.entity.query.filter_by(**filter).first() or None
+        self.value = req.GET and self.fetch_query().filter_by(**filter).first() or None
 
     @classmethod
     def validated_request(cls, req, data, protect_prm_tamp=True, do_commit=True):
         if 'id' not in data and 'id' in req.GET:
             # If the 'id' is in the query string, we get it
             data['id'] = req.GET['id']
+        changes = set()
         utils.update_or_create(cls.entity, data,
-                               protect_prm_tamp=protect_prm_tamp)
+                               protect_prm_tamp=protect_prm_tamp,
+                               changes=changes)
+        if changes:
+            # The many-to-many collections may be written with statements
+            # the zope transaction does not see
+            mark_changed(cls.entity.query.session)
         if do_commit:
             transaction.commit()
 
@@ -189,18 +376,56 @@ class DbListForm(DbPage, twf.FormPage):
     """
     A page that contains a list form with database synchronisation. The `fetch_data` method loads a full
     table from the database. The `validated_request` method saves the data to the database.
+
+    The rows edited by the form are the ones of `scope_query`, which are
+    the rows displayed on GET. On POST, only the submitted rows are loaded:
+    a submitted row which is not in the scope is created, and the rows of
+    the scope which are not submitted are deleted, which reads the primary
+    keys of the whole scope.
+
+    With `bulk`, the rows are saved with batches of INSERT, UPDATE and DELETE
+    statements without loading the objects (see `utils.bulk_from_list`), so
+    no ORM event is triggered for them.
     """
     redirect = twc.Param('Location to redirect to after successful POST',
                          request_local=False, default=None)
+    bulk = twc.Param('Save the rows with bulk statements',
+                     request_local=False, default=False)
+    batch_size = twc.Param('Number of rows per bulk statement',
+                           request_local=False, default=500)
     _no_autoid = True
 
     def fetch_data(self, req):
-        self.value = self.entity.query.all()
+        self.value = self.fetch_query(self.scope_query(req)).all()
+
+    @classmethod
+    def scope_query(cls, req):
+        """Returns the query of the rows edited by the form, all the rows of
+        the entity by default. Override it when the form shows a subset of
+        the rows, so that the other ones are neither updated nor deleted.
+        """
+        return cls.entity.query
 
     @classmethod
     def validated_request(cls, req, data, protect_prm_tamp=True, do_commit=True):
-        utils.from_list(cls.entity, cls.entity.query.all(), data,
-                        force_delete=True, protect_prm_tamp=protect_prm_tamp)
+        scope = cls.scope_query(req)
+        if cls.bulk:
+            counts = utils.bulk_from_list(
+                cls.entity, data, force_delete=True,
+                protect_prm_tamp=protect_prm_tamp, batch_size=cls.batch_size,
+                query=scope)
+            if counts is not None:
+                # The statements are not seen by the zope transaction
+                session = cls.entity.query.session
+                mark_changed(session)
+                _options_changed(session, [cls.entity])
+        else:
+            changes = set()
+            utils.update_list(cls.entity, data, scope, force_delete=True,
+                              protect_prm_tamp=protect_prm_tamp,
+                              changes=changes)
+            if changes:
+                mark_changed(cls.entity.query.session)
         if do_commit:
             transaction.commit()
 
@@ -214,18 +439,270 @@ class DbListPage(DbPage, twc.Page):
     """
     A page that contains a list with database synchronisation. The `fetch_data` method loads a full
     table from the database; there is no submit or write capability.    
+
+    When `page_size` is set, only one page of rows is loaded. The pages are
+    selected with a keyset cursor taken from the `after` or `before` query
+    string parameter, or with the `page` parameter (OFFSET) when the
+    ordering values can't be used in a cursor. Links to the previous and
+    next pages are rendered below the list.
+
+    When `stream` is set (and `page_size` is not), the rows are loaded with
+    `yield_per` and the response body is an iterator: the page is displayed
+    once without its rows, then the rows of the child, which must be a
+    RepeatingWidget like GridLayout, are sent by batches of `batch_size`
+    rows between the parts of the page before and after them. The rows are
+    loaded after the request returns, in a session and a connection owned
+    by the iterator and closed when it ends; they are read from the replicas
+    of a `routing_session`, in a read-only transaction if `read_only` is set.
     """
     newlink = twc.Param('New item widget', default=None)
+    page_size = twc.Param('Number of rows per page, None to show all the rows',
+                          request_local=False, default=None)
+    order_by = twc.Param('Names of the attributes used to order the rows. '
+                         'The primary key is always added to make the order '
+                         'unique', request_local=False, default=[])
+    stream = twc.Param('Send the rows by batches while they are loaded',
+                       request_local=False, default=False)
+    batch_size = twc.Param('Number of rows per batch in stream mode',
+                           request_local=False, default=100)
+    prev_link = twc.Variable('Url of the previous page', default=None)
+    next_link = twc.Variable('Url of the next page', default=None)
     template = 'tw2.sqla.templates.dblistpage'
     _no_autoid = True
+    _streamed = False
 
     def fetch_data(self, req):
-        self.value = self.entity.query.all()
+        if self.page_size:
+            self.value = self.fetch_page(self.fetch_query(), req)
+        elif self.stream:
+            # The eager loading of collections can't be combined with
+            # yield_per
+            self.value = self.entity.query.yield_per(self.batch_size)
+        else:
+            self.value = self.fetch_query().all()
+
+    @classmethod
+    def request(cls, req):
+        if not cls.stream or cls.page_size:
+            return super(DbListPage, cls).request(req)
+
+        ct = cls.content_type
+        if isinstance(ct, twc.Deferred):
+            ct = ct.fn()
+        resp = webob.Response(request=req, content_type=ct)
+        ins = cls.req()
+        ins.fetch_data(req)
+        with replica_reads(_client_write(req)):
+            resp.app_iter = ins.iter_display()
+        return resp
+
+    def iter_display(self):
+        """Returns an iterator over the encoded chunks of the page"""
+        # The middleware clears the request local data before the response
+        # body is iterated.
+        saved = dict(twc.core.request_local())
+        last_write = getattr(_replica_local, 'last_write', 0)
+
+        def chunks():
+            rl = twc.core.request_local()
+            rl.update(saved)
+            encoding = rl['middleware'].config.encoding
+            rows = self.value
+
+            self.value = []
+            self._streamed = True
+            header, footer = self.display().split(_StreamedRows.marker)
+            yield header.encode(encoding)
+
+            session = connection = None
+            if isinstance(rows, sa.orm.Query):
+                # The request transaction is over, and a query in the
+                # scoped session would join a new one that nobody ends.
+                with replica_reads(last_write):
+                    bind = rows.session.get_bind(
+                        sa.orm.class_mapper(self.entity))
+                connection = bind.connect()
+                session = sa.orm.Session(bind=connection, autoflush=False)
+                if self.read_only:
+                    sa.event.listen(session, 'after_begin', _set_read_only)
+                rows = rows.with_session(session)
+            try:
+                bunch = self.child.children.bunch
+                batch = []
+                for i, row in enumerate(rows):
+                    batch.append(self._display_row(bunch, i, row))
+                    if len(batch) == self.batch_size:
+                        yield u''.join(batch).encode(encoding)
+                        batch = []
+                if batch:
+                    yield u''.join(batch).encode(encoding)
+            finally:
+                if session is not None:
+                    session.close()
+                    connection.close()
+            yield footer.encode(encoding)
+        return chunks()
+
+    def _display_row(self, bunch, i, row):
+        # The first row was prepared without value for the header
+        bunch._repetition_cache.pop(i, None)
+        rep = bunch[i]
+        rep.value = row
+        rep.prepare()
+        try:
+            return rep.display()
+        finally:
+            # Don't keep the displayed rows, nor a widget class per row
+            bunch._repetition_cache.pop(i, None)
+            bunch.rwbc._repetition_cache.pop(i, None)
+
+    def order_columns(self):
+        """Returns the attributes used to order the rows"""
+        names = list(self.order_by)
+        for col in sa.orm.class_mapper(self.entity).primary_key:
+            if col.key not in names:
+                names.append(col.key)
+        return [getattr(self.entity, name) for name in names]
+
+    def fetch_page(self, query, req):
+        """Returns the rows of the page requested in the query string of
+        `req` and set the links to the previous and next pages.
+
+        The NULL ordering values are sorted last on all the databases. The
+        databases without NULLS LAST sort them with a CASE expression, which
+        keeps an index from serving the ordering: declare the `order_by`
+        columns NOT NULL there.
+        """
+        columns = self.order_columns()
+        nullable = [getattr(c.property.columns[0], 'nullable', True)
+                    for c in columns]
+        size = self.page_size
+
+        def valid(col, nullable, value):
+            if value is None:
+                return nullable
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, long, float, basestring)):
+                return False
+            try:
+                numeric = issubclass(col.property.columns[0].type.python_type,
+                                     (int, long, float, decimal.Decimal))
+            except (AttributeError, NotImplementedError):
+                return True
+            return numeric != isinstance(value, basestring)
+
+        def cursor(key):
+            try:
+                values = json.loads(req.GET[key])
+            except (KeyError, ValueError):
+                return None
+            if not isinstance(values, list) or len(values) != len(columns):
+                return None
+            # Fall back to the page parameter
+            if not all(valid(*args) for args in
+                       zip(columns, nullable, values)):
+                return None
+            return values
+
+        nulls_order = _nulls_order(query.session.get_bind(
+            sa.orm.class_mapper(self.entity)).dialect)
+
+        def order(desc=False):
+            clauses = []
+            for col, null in zip(columns, nullable):
+                if null and not nulls_order:
+                    key = sa.case([(col == None, 1)], else_=0)
+                    if desc:
+                        key = key.desc()
+                    clauses.append(key)
+                if desc:
+                    clause = col.desc()
+                    if null and nulls_order:
+                        clause = clause.nullsfirst()
+                elif null and nulls_order:
+                    clause = col.nullslast()
+                else:
+                    clause = col
+                clauses.append(clause)
+            return clauses
+
+        def after(values, reverse=False):
+            # Row comparison (c1, c2, ...) > (v1, v2, ...) written with
+            # AND/OR since not all the databases support it, the NULLs
+            # coming last.
+            clauses = []
+            equal = []
+            for col, null, v in zip(columns, nullable, values):
+                if v is None:
+                    if reverse:
+                        clauses.append(sa.and_(col != None, *equal))
+                    equal.append(col == None)
+                else:
+                    if reverse:
+                        clause = col < v
+                    elif null:
+                        clause = sa.or_(col > v, col == None)
+                    else:
+                        clause = col > v
+                    clauses.append(sa.and_(clause, *equal))
+                    equal.append(col == v)
+            return sa.or_(*clauses)
+
+        after_values = cursor('after')
+        before_values = cursor('before')
+        try:
+            page = max(int(req.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        has_prev = False
+        if before_values is not None:
+            rows = query.filter(after(before_values, reverse=True)) \
+                        .order_by(*order(desc=True)) \
+                        .limit(size + 1).all()
+            has_prev = len(rows) > size
+            rows = list(reversed(rows[:size]))
+            has_next = True
+        else:
+            query = query.order_by(*order())
+            if after_values is not None:
+                query = query.filter(after(after_values))
+                has_prev = True
+            elif page > 1:
+                query = query.offset((page - 1) * size)
+                has_prev = True
+            rows = query.limit(size + 1).all()
+            has_next = len(rows) > size
+            rows = rows[:size]
+
+        params = dict((k, unicode(v).encode('utf-8'))
+                      for k, v in req.GET.items()
+                      if k not in ('after', 'before', 'page'))
+
+        def link(key, row, page):
+            params_ = dict(params)
+            try:
+                params_[key] = json.dumps([getattr(row, c.key)
+                                           for c in columns])
+            except TypeError:
+                # The ordering values can't be used in a cursor
+                params_['page'] = page
+            return '?' + urllib.urlencode(params_)
+
+        if rows and has_prev:
+            self.prev_link = link('before', rows[0], page - 1)
+        if rows and has_next:
+            self.next_link = link('after', rows[-1], page + 1)
+        return rows
 
     @classmethod
     def post_define(cls):
         if cls.newlink:
             cls.newlink = cls.newlink(parent=cls)
+        if cls.stream and getattr(cls, 'child', None) and \
+           not issubclass(cls.child, twc.RepeatingWidget):
+            raise twc.WidgetError('The child of a streamed DbListPage must '
+                                  'be a RepeatingWidget')
 
     def __init__(self, **kw):
         super(DbListPage, self).__init__(**kw)
@@ -236,6 +713,42 @@ class DbListPage(DbPage, twc.Page):
         super(DbListPage, self).prepare()
         if self.newlink:
             self.newlink.prepare()
+        if self._streamed:
+            self.child.children = _StreamedRows(self.child.children)
+
+
+def _nulls_order(dialect):
+    """Returns True if the dialect supports NULLS FIRST / NULLS LAST"""
+    if dialect.name in ('postgresql', 'oracle'):
+        return True
+    if dialect.name == 'sqlite':
+        return getattr(dialect.dbapi, 'sqlite_version_info', ()) >= (3, 30)
+    return False
+
+
+class _StreamedRows(object):
+    """Stands for the rows of the child of a streamed DbListPage when the
+    rest of the page is displayed.
+    """
+    marker = u'tw2_sqla_streamed_rows'
+
+    def __init__(self, bunch):
+        self.bunch = bunch
+
+    def __len__(self):
+        return len(self.bunch)
+
+    def __iter__(self):
+        yield self
+
+    def __getitem__(self, item):
+        return self.bunch[item]
+
+    def prepare(self):
+        pass
+
+    def display(self, *args, **kw):
+        return self.marker
 
 
 class DbLabelField(twf.LabelField):
@@ -306,13 +819,291 @@ class DbListLinkField(twc.RepeatingWidget):
         super(DbListLinkField, self).prepare()
 
 
+_options_caches = weakref.WeakSet()
+_options_changes = weakref.WeakKeyDictionary()
+
+def _invalidate_options(entity):
+    """Invalidates the options of entity in all the OptionsCaches
+    """
+    for cache in list(_options_caches):
+        cache.invalidate(entity)
+
+def _options_changed(session, entities):
+    """Invalidates the options of the modified entities, and records them so
+    that they are invalidated again when the transaction of session ends:
+    the options reloaded in between may hold uncommitted rows, or miss them.
+    """
+    if not _options_caches:
+        return
+    changes = _options_changes.setdefault(session, set())
+    for mapper in set(sa.orm.class_mapper(e).base_mapper for e in entities):
+        changes.add(mapper.class_)
+        _invalidate_options(mapper.class_)
+
+def _options_after_flush(session, flush_context):
+    objs = list(session.new) + list(session.dirty) + list(session.deleted)
+    _options_changed(session, set(type(o) for o in objs))
+
+def _options_after_bulk(session, query, *args):
+    _options_changed(session, [desc['type'] for desc in
+                               query.column_descriptions
+                               if isinstance(desc.get('type'), type)])
+
+def _options_end(session, transaction):
+    for entity in _options_changes.get(session, ()):
+        _invalidate_options(entity)
+    # Only the end of the root transaction leaves no transaction behind
+    if session.transaction is None:
+        _options_changes.pop(session, None)
+
+sa.event.listen(sa.orm.Session, 'after_flush', _options_after_flush)
+sa.event.listen(sa.orm.Session, 'after_bulk_update', _options_after_bulk)
+sa.event.listen(sa.orm.Session, 'after_bulk_delete', _options_after_bulk)
+sa.event.listen(sa.orm.Session, 'after_transaction_end', _options_end)
+
+
+class OptionsCache(object):
+    """Cache of the options of the selection fields, shared between requests.
+
+    The options of an entity are loaded once, then reused until the entity
+    is modified through the ORM: the flushes, the bulk `Query.update` and
+    `Query.delete`, and the bulk saves of DbListForm invalidate the cached
+    options of the modified entity, and invalidate them again when the
+    transaction ends.
+    Modifications made outside of the ORM or by other processes are not
+    seen, use `ttl` for them.
+
+    `ttl`
+        Number of seconds the options stay cached, None for no limit.
+
+    `maxsize`
+        Maximum number of cached options lists, the least recently used list
+        is dropped first. None for no limit.
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._order = []
+        self._generation = 0
+        self._lock = threading.RLock()
+        _options_caches.add(self)
+
+    def get(self, entity, key, loader):
+        """Returns the options cached for `entity` and `key`, calling
+        `loader` to load them if they are not cached.
+        """
+        ckey = (entity, key)
+        with self._lock:
+            if ckey in self._data:
+                expires, options = self._data[ckey]
+                self._order.remove(ckey)
+                if expires is None or expires > time.time():
+                    self._order.append(ckey)
+                    return options
+                del self._data[ckey]
+            generation = self._generation
+
+        options = loader()
+
+        with self._lock:
+            # Don't store options which have been loaded while the entity
+            # was modified.
+            if generation == self._generation:
+                if ckey in self._data:
+                    self._order.remove(ckey)
+                expires = self.ttl is not None and time.time() + self.ttl or None
+                self._data[ckey] = (expires, options)
+                self._order.append(ckey)
+                while self.maxsize is not None and \
+                      len(self._order) > self.maxsize:
+                    del self._data[self._order.pop(0)]
+        return options
+
+    def invalidate(self, entity=None):
+        """Drop the options of `entity` and of the entities sharing its
+        table hierarchy, or all the options if `entity` is None.
+        """
+        base_mapper = entity and sa.orm.class_mapper(entity).base_mapper
+        with self._lock:
+            self._generation += 1
+            for ckey in list(self._order):
+                if base_mapper is None or \
+                   sa.orm.class_mapper(ckey[0]).base_mapper is base_mapper:
+                    self._order.remove(ckey)
+                    del self._data[ckey]
+
+
+def _label_column(entity):
+    """Returns the SQL expression declared as `tws_label` on the entity, the
+    name of a column attribute or an SQL expression, or None.
+    """
+    label = getattr(entity, 'tws_label', None)
+    if isinstance(label, basestring):
+        label = getattr(entity, label)
+    return label
+
+
+class DbOptionsSearch(twc.Widget):
+    """JSON controller searching the options of a remote DbSelectionField.
+
+    The GET parameters are `q`, the text to search in the `tws_label` of the
+    entity, `match`, 'prefix' (default) or 'substring', and `after`, the
+    value returned by the previous response to get the next options. The
+    response looks like::
+
+        {"options": [[1, "foo1"], [2, "foo2"]], "after": 2}
+
+    `after` is null when there is no more option.
+    """
+    entity = twc.Param('SQLAlchemy mapped class to use', request_local=False)
+    limit = twc.Param('Maximum number of options per response',
+                      request_local=False, default=20)
+
+    @classmethod
+    def request(cls, req):
+        with replica_reads(_client_write(req)):
+            return cls.search(req)
+
+    @classmethod
+    def search(cls, req):
+        """Returns the response to the search request req"""
+        pkey = getattr(cls.entity,
+                       sa.orm.class_mapper(cls.entity).primary_key[0].key)
+        label = _label_column(cls.entity)
+
+        query = cls.entity.query.with_entities(pkey, label)
+        text = req.GET.get('q', '')
+        if text:
+            text = text.replace(u'\\', u'\\\\').replace(u'%', u'\\%') \
+                       .replace(u'_', u'\\_')
+            if req.GET.get('match') == 'substring':
+                text = u'%' + text
+            query = query.filter(label.ilike(text + u'%', escape=u'\\'))
+        after = req.GET.get('after')
+        if after:
+            try:
+                after = RelatedValidator(cls.entity).coerce(after)
+            except twc.ValidationError:
+                return webob.Response(request=req, status=400)
+            query = query.filter(pkey > after)
+        rows = query.order_by(pkey).limit(cls.limit).all()
+
+        data = {
+            'options': [[k, v is not None and unicode(v) or u'']
+                        for k, v in rows],
+            'after': None,
+        }
+        if len(rows) == cls.limit:
+            data['after'] = rows[-1][0]
+        return webob.Response(request=req, content_type='application/json',
+                              body=json.dumps(data))
+
+
 class DbSelectionField(twf.SelectionField):
     entity = twc.Param('SQLAlchemy mapped class to use', request_local=False)
+    options_cache = twc.Param('OptionsCache used to keep the options between '
+                              'the requests, None to load them on each '
+                              'request', request_local=False, default=None)
+    remote = twc.Param('Only render the selected options; the others are '
+                       'searched through the DbOptionsSearch controller '
+                       'given as `search`, whose url is set in the '
+                       'data-search-url attribute. The entity must define '
+                       'tws_label', request_local=False, default=False)
+    search_limit = twc.Param('Maximum number of options returned by a search',
+                             request_local=False, default=20)
+
+    @classmethod
+    def post_define(cls):
+        if getattr(cls, 'entity', None) and cls.remote:
+            if _label_column(cls.entity) is None:
+                raise twc.WidgetError(
+                    "The entity %s must define tws_label to be used in a "
+                    "remote selection field" % cls.entity.__name__)
+            # The fields of an entity sharing a limit share the controller
+            cls.search = DbOptionsSearch(
+                id='%s_options_%d' % (cls.entity.__name__.lower(),
+                                      cls.search_limit),
+                entity=cls.entity, limit=cls.search_limit)
+
+    def prepare(self):
+        if self.remote:
+            self.safe_modify('attrs')
+            self.attrs['data-search-url'] = self.search.get_link()
+        super(DbSelectionField, self).prepare()
+
+    def load_options(self, validator):
+        """Returns the (primary key, label) options of the entity.
+
+        If the entity defines `tws_label`, the name of a column attribute or
+        an SQL expression, only the primary key and the label are selected.
+        Otherwise the objects are loaded and `unicode` gives the labels.
+
+        In remote mode only the options of the current value are returned.
+
+        The options are read from the replicas of a `routing_session`, except
+        the ones kept in the `options_cache`, which are read from the
+        primary: the cache would keep the options of a replica behind it.
+        """
+        with replica_reads():
+            return self._load_options(validator)
+
+    def _load_options(self, validator):
+        pkey_name = validator.primary_key.name
+        label = _label_column(self.entity)
+
+        if self.remote:
+            return self._selected_options(validator, label)
+
+        if label is None:
+            label_key = unicode
+            def loader():
+                return [(getattr(x, pkey_name), unicode(x))
+                        for x in self.entity.query.all()]
+        else:
+            label_key = label
+            def loader():
+                query = self.entity.query.with_entities(
+                    getattr(self.entity, pkey_name), label)
+                return [(pkey, text is not None and unicode(text) or u'')
+                        for pkey, text in query]
+
+        if self.options_cache is None:
+            return loader()
+
+        def primary_loader():
+            with _primary_reads():
+                return loader()
+        return self.options_cache.get(self.entity, (pkey_name, label_key),
+                                      primary_loader)
+
+    def _selected_options(self, validator, label):
+        values = self.value
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+
+        pkeys = []
+        for v in values:
+            if isinstance(v, self.entity):
+                pkeys.append(getattr(v, validator.primary_key.name))
+            elif v is not None and v != '':
+                try:
+                    pkeys.append(validator.coerce(v))
+                except twc.ValidationError:
+                    pass
+        if not pkeys:
+            return []
+
+        pkey = getattr(self.entity, validator.primary_key.name)
+        query = self.entity.query.with_entities(pkey, label).filter(
+            pkey.in_(pkeys))
+        return [(k, v is not None and unicode(v) or u'') for k, v in query]
 
 
 class DbSingleSelectionField(DbSelectionField):
     def prepare(self):
-        self.options = [(getattr(x, self.validator.primary_key.name), unicode(x)) for x in self.entity.query.all()]
+        self.options = self.load_options(self.validator)
         super(DbSingleSelectionField, self).prepare()
 
     @classmethod
@@ -323,15 +1114,20 @@ class DbSingleSelectionField(DbSelectionField):
 
 
 class DbMultipleSelectionField(DbSelectionField):
+    batch = twc.Param('Load the submitted ids with a single IN query, see '
+                      'RelatedItemValidator', request_local=False,
+                      default=False)
+
     def prepare(self):
-        self.options = [(getattr(x, self.item_validator.primary_key.name), unicode(x)) for x in self.entity.query.all()]
+        self.options = self.load_options(self.item_validator)
         super(DbMultipleSelectionField, self).prepare()
 
     @classmethod
     def post_define(cls):
         if getattr(cls, 'entity', None):
             required = getattr(cls.validator, 'required', None)
-            cls.validator = RelatedItemValidator(required=required, entity=cls.entity)
+            cls.validator = RelatedItemValidator(required=required, entity=cls.entity,
+                                                 batch=cls.batch)
             # We should keep item_validator to make sure the values are well transformed.
             cls.item_validator = RelatedValidator(entity=cls.entity)
 
@@ -371,7 +1167,211 @@ def commit_veto(environ, status, headers):
     """
     return not 200 <= int(status.split(None, 1)[0]) < 400
 
+# The scoped sessions made by transactional_session, see read_only_session
+_scoped_sessions = weakref.WeakSet()
+
 def transactional_session():
     """Return an SQLAlchemy scoped_session. If called from a script, use ZopeTransactionExtension so the session is integrated with repoze.tm. The extention is not enabled if called from the interactive interpreter."""
-    return sa.orm.scoped_session(sa.orm.sessionmaker(autoflush=True, autocommit=False,
+    session = sa.orm.scoped_session(sa.orm.sessionmaker(autoflush=True, autocommit=False,
+            extension=sys.argv[0] and ZopeTransactionExtension() or None))
+    _scoped_sessions.add(session)
+    return session
+
+
+# Whether the reads of the routing sessions go to the replicas, and the time
+# of the last write of the client, per thread
+_replica_local = threading.local()
+
+# The cookie holding the time of the last write of the client, set by the
+# POST requests of the DbPages which wrote through a RoutingSession
+write_cookie = 'tw2_sqla_write'
+
+def _client_write(req):
+    """Returns the time of the last write of the client of req, or 0"""
+    try:
+        return float(req.cookies.get(write_cookie, 0))
+    except ValueError:
+        return 0
+
+@contextlib.contextmanager
+def replica_reads(last_write=None):
+    """Context manager sending the reads of the routing sessions (see
+    `routing_session`) of the current thread to the replicas. `last_write`
+    is the time of the last write of the client, None to keep the current
+    one.
+    """
+    previous = (getattr(_replica_local, 'active', False),
+                getattr(_replica_local, 'last_write', 0))
+    _replica_local.active = True
+    if last_write is not None:
+        _replica_local.last_write = last_write
+    try:
+        yield
+    finally:
+        _replica_local.active, _replica_local.last_write = previous
+
+@contextlib.contextmanager
+def _primary_reads():
+    """Context manager sending the reads of the routing sessions of the
+    current thread to the primary, inside replica_reads
+    """
+    active = getattr(_replica_local, 'active', False)
+    _replica_local.active = False
+    try:
+        yield
+    finally:
+        _replica_local.active = active
+
+def _is_write(clause):
+    """Returns whether the statement clause may write"""
+    if isinstance(clause, sa.sql.expression.UpdateBase):
+        return True
+    if isinstance(clause, sa.sql.expression.TextClause):
+        words = clause.text.split(None, 1)
+        return not words or words[0].upper() != 'SELECT'
+    return False
+
+class RoutingSession(sa.orm.Session):
+    """
+    Session reading from one of the `replicas` engines inside replica_reads,
+    and from the `primary` engine otherwise. The replica is chosen once per
+    transaction.
+
+    The flushes, the INSERT, UPDATE and DELETE statements and the textual
+    statements other than SELECT go to the primary, and so do the next
+    reads of the transaction. After a write, the reads of the thread stay
+    on the primary for `window` seconds. The
+    DbPages send the time of the write to the client in the `write_cookie`
+    cookie, and the reads of its next requests stay on the primary until
+    the window is over, so that the page shown after a POST (or its
+    redirect) sees the written rows, whichever process serves it.
+    """
+    primary = None
+    replicas = ()
+    window = 5
+    _replica = None
+    _wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if _is_write(clause):
+            self._write()
+        if self._wrote:
+            return self.primary
+        if self.replicas and getattr(_replica_local, 'active', False) and \
+           time.time() - getattr(_replica_local, 'last_write', 0) >= \
+           self.window:
+            if self._replica is None:
+                self._replica = random.choice(self.replicas)
+            return self._replica
+        return self.primary
+
+    def _write(self):
+        self._wrote = True
+        _replica_local.last_write = time.time()
+
+    def close(self):
+        self._replica = None
+        self._wrote = False
+        super(RoutingSession, self).close()
+
+    def commit(self):
+        self._replica = None
+        self._wrote = False
+        super(RoutingSession, self).commit()
+
+    def rollback(self):
+        self._replica = None
+        self._wrote = False
+        super(RoutingSession, self).rollback()
+
+def _routing_before_flush(session, flush_context, instances):
+    session._write()
+
+sa.event.listen(RoutingSession, 'before_flush', _routing_before_flush)
+
+def routing_session(primary, replicas=(), window=5):
+    """Return an SQLAlchemy scoped_session like transactional_session, whose
+    sessions are RoutingSession: the reads of the pages and of the options
+    go to one of the `replicas` engines, the rest to the `primary` engine.
+    """
+    session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            class_=RoutingSession, autoflush=True, autocommit=False,
             extension=sys.argv[0] and ZopeTransactionExtension() or None))
+    cls = session.session_factory.class_
+    cls.primary = primary
+    cls.replicas = tuple(replicas)
+    cls.window = window
+    _scoped_sessions.add(session)
+    return session
+
+
+# The databases supporting SET TRANSACTION READ ONLY
+read_only_dialects = ('postgresql', 'mysql', 'oracle')
+
+def _set_read_only(session, transaction, connection):
+    if connection.dialect.name in read_only_dialects:
+        connection.execute('SET TRANSACTION READ ONLY')
+
+# {scoped_session: thread-local registry of its read-only sessions}
+_read_only_registries = weakref.WeakKeyDictionary()
+# {entity: the scoped_session of its query property}
+_entity_scopes = weakref.WeakKeyDictionary()
+
+def _read_only_registry(scoped):
+    registry = _read_only_registries.get(scoped)
+    if registry is None:
+        kw = dict(scoped.session_factory.kw, autoflush=False, extension=None)
+        factory = sa.orm.sessionmaker(class_=scoped.session_factory.class_,
+                                      **kw)
+        sa.event.listen(factory, 'after_begin', _set_read_only)
+        registry = sa.util.ThreadLocalRegistry(factory)
+        _read_only_registries[scoped] = registry
+    return registry
+
+def _entity_scope(entity):
+    """Returns the scoped_session made by transactional_session which the
+    query property of entity uses, or None
+    """
+    scoped = _entity_scopes.get(entity)
+    if scoped is None:
+        current = entity.query.session
+        for scoped in list(_scoped_sessions):
+            if scoped.registry.has() and scoped.registry() is current:
+                _entity_scopes[entity] = scoped
+                break
+        else:
+            scoped = None
+    return scoped
+
+@contextlib.contextmanager
+def read_only_session(entity):
+    """Context manager running the queries of entity, and of the entities
+    sharing its scoped_session, in a separate read-only session: without
+    autoflush, out of the zope transaction, in a transaction started with
+    SET TRANSACTION READ ONLY on the databases of `read_only_dialects`. On
+    exit, the session is closed, returning its connection to the pool, and
+    the previous session is restored.
+
+    The current session is kept if it has pending changes, or if it was not
+    made by transactional_session.
+    """
+    scoped = _entity_scope(entity)
+    if scoped is None:
+        current = entity.query.session
+    else:
+        current = scoped.registry()
+        registry = _read_only_registry(scoped)
+    if scoped is None or not current._is_clean() or \
+       (registry.has() and registry() is current):
+        with current.no_autoflush:
+            yield current
+        return
+
+    # The session is kept for the next requests of the thread
+    session = registry()
+    scoped.registry.set(session)
+    try:
+        yield session
+    finally:
+        session.close()
+        scoped.registry.set(current)